@@ -0,0 +1,435 @@
+'''
+Offline benchmark of the bot. It builds synthetic game threads (a GM day
+start post with the player list, player chat, h4 votes and unvotes, h2 phase
+headers and bot vote counts), serves them from a local HTTP stub that mimics
+mediavida URLs, pagination and conditional requests, and drives MafiaBot
+ticks against it.
+
+For every thread size it reports, per tick, the wall time, requests issued,
+bytes transferred, time spent parsing pages and peak traced memory.
+
+Usage:
+    python benchmark.py --pages 10 100 1000 [--parsers lxml html.parser] [--parse-workers 0 4]
+                        [--no-cache] [--no-memory] [--json results.json]
+
+Memory tracing slows Python down noticeably, use --no-memory for timings
+closer to production.
+'''
+import argparse
+import hashlib
+import http.server
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import http_client
+import mafia_bot
+import page_cache
+import post_queue
+import state_store
+import thread_parser
+
+POSTS_PER_PAGE = 30
+
+GAME_MASTER = 'BenchGM'
+BOT_ID      = 'BenchBot'
+PLAYERS     = [f'Player{number}' for number in range(20)]
+THREAD_ID   = 424242
+
+# Page chrome so parsing cost resembles a real mediavida page
+PAGE_HEADER = ('<html><head><title>Partida de mafia</title></head><body>'
+               '<div id="header">' + '<a href="/foro">Foro</a>' * 40 + '</div>'
+               '<div id="sidebar">' + '<div class="widget"><p>Lorem ipsum dolor sit amet</p></div>' * 20 + '</div>'
+               '<div id="posts">')
+SIGNATURE   = '<div class="firma"><p>Firma del usuario con <a href="#">enlaces</a> y <b>formato</b></p></div>'
+
+
+class StubForum:
+    '''
+    Synthetic game thread. Posts are kept as (author, html body) and pages
+    are rendered on demand.
+    '''
+
+    def __init__(self, thread_url:str):
+
+        self.thread_url = thread_url
+        self.posts      = []
+        self._lock      = threading.Lock()
+
+
+    def add_post(self, author:str, body:str) -> int:
+
+        with self._lock:
+            self.posts.append((author, body))
+            return len(self.posts)
+
+
+    def populate(self, pages:int):
+        '''
+        Fills the thread with a day start post followed by player posts.
+        Every eighth post carries a vote; players unvote before switching, so
+        nobody reaches majority and the whole day is always counted.
+        '''
+
+        self.add_post(GAME_MASTER, '<h2>Día 1</h2><h3>Jugadores vivos</h3><ol>'
+                      + ''.join(f'<li><a href="{self.thread_url}?u={player}">{player}</a></li>' for player in PLAYERS)
+                      + '</ol>')
+
+        votes_cast = {}
+
+        for post_number in range(2, pages * POSTS_PER_PAGE + 1):
+            self.add_post(*self.get_player_post(post_number, votes_cast))
+
+
+    def add_activity(self, posts:int):
+        '''
+        Appends new player posts, as happens between two ticks.
+        '''
+
+        votes_cast = {}
+
+        for post_number in range(len(self.posts) + 1, len(self.posts) + posts + 1):
+            self.add_post(*self.get_player_post(post_number, votes_cast))
+
+
+    def get_player_post(self, post_number:int, votes_cast:dict) -> tuple:
+
+        author = PLAYERS[post_number % len(PLAYERS)]
+        body   = f'<p>Mensaje {post_number}. ' + 'Creo que hay algo raro aquí. ' * 6 + '</p>'
+
+        if post_number % 8 == 0:
+
+            victim = PLAYERS[(post_number // 8) % len(PLAYERS)]
+
+            if votes_cast.get(author):
+                body += '<h4>desvoto</h4>'
+
+            body += f'<h4>voto {victim}</h4>'
+            votes_cast[author] = victim
+
+        return author, body
+
+
+    def render_page(self, page:int, author:str=None) -> str:
+
+        with self._lock:
+            posts = [(number, post_author, body) for number, (post_author, body) in enumerate(self.posts, start=1)
+                     if author is None or post_author.lower() == author.lower()]
+
+        page_count = max(1, math.ceil(len(posts) / POSTS_PER_PAGE))
+        page_posts = posts[(page - 1) * POSTS_PER_PAGE:page * POSTS_PER_PAGE]
+
+        html = [PAGE_HEADER]
+
+        for position, (number, post_author, body) in enumerate(page_posts):
+
+            post_class = 'cf post first' if position == 0 else ('cf post z' if position % 2 else 'cf post')
+
+            html.append(f'<div class="{post_class}" data-num="{number}" data-autor="{post_author}">'
+                        f'<div class="post-meta"><a href="#{number}">#{number}</a> {post_author}</div>'
+                        f'<div class="post-contents">{body}</div>{SIGNATURE}</div>')
+
+        html.append('</div><div id="bottompanel">')
+        html.append(''.join(f'<a href="{self.thread_url}/{number}">{number}</a>' for number in range(1, page_count + 1)))
+
+        # Like mediavida, only pages before the last one link to the next page
+        if page < page_count:
+            html.append('<a href="#">Siguiente</a>')
+
+        html.append('</div></body></html>')
+
+        return ''.join(html)
+
+
+class StubSession:
+    '''
+    Stands in for user.ForumSession. Posts are appended to the stub forum
+    instead of being sent to mediavida.
+    '''
+
+    def __init__(self, forum:StubForum):
+
+        self.forum = forum
+        self.posts = 0
+
+
+    def get_browser(self):
+
+        return None
+
+
+    def post(self, thread_id:int, message:str) -> str:
+
+        # Vote count titles are markdown h1 lines, rendered as h2 by the forum
+        body    = re.sub('^# (.*?) *$', r'<h2>\1</h2>', message, flags=re.MULTILINE)
+        post_id = self.forum.add_post(BOT_ID, body)
+
+        self.posts += 1
+
+        return f'{self.forum.thread_url}/{math.ceil(post_id / POSTS_PER_PAGE)}#{post_id}'
+
+
+def make_handler(forum:StubForum):
+    '''
+    Builds a request handler serving the stub forum with mediavida URLs:
+    /<thread>, /<thread>/<page> and /<thread>?u=<user>&pagina=<page>.
+    Responses carry an ETag and honour If-None-Match.
+    '''
+
+    thread_path = urllib.parse.urlsplit(forum.thread_url).path
+
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+
+            url   = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+
+            if url.path == thread_path:
+                page = 1
+            elif url.path.startswith(thread_path + '/'):
+                page = int(url.path[len(thread_path) + 1:])
+            else:
+                self.send_error(404)
+                return
+
+            author = query.get('u', [None])[0]
+            page   = int(query.get('pagina', [page])[0])
+
+            body = forum.render_page(page, author).encode('utf-8')
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+class ParseTimer:
+    '''
+    Wraps thread_parser.parse_page and thread_parser.parse_pages to
+    accumulate the time spent parsing. Batches parsed in the process pool
+    count their wall time.
+    '''
+
+    def __init__(self):
+
+        self.seconds = 0.0
+        self.pages   = 0
+        self._parse  = thread_parser.parse_page
+        self._parse_pages = thread_parser.parse_pages
+        self._in_batch    = False
+
+
+    def __enter__(self):
+
+        def timed_parse(*args, **kwargs):
+
+            if self._in_batch:
+                return self._parse(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return self._parse(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+                self.pages   += 1
+
+        def timed_parse_pages(request_texts):
+            start = time.perf_counter()
+            self._in_batch = True
+            try:
+                return self._parse_pages(request_texts)
+            finally:
+                self._in_batch = False
+                self.seconds += time.perf_counter() - start
+                self.pages   += len(request_texts)
+
+        thread_parser.parse_page  = timed_parse
+        thread_parser.parse_pages = timed_parse_pages
+        return self
+
+
+    def __exit__(self, *exc):
+
+        thread_parser.parse_page  = self._parse
+        thread_parser.parse_pages = self._parse_pages
+
+
+def write_vote_config(path:str):
+
+    with open(path, 'w') as vote_config:
+        vote_config.write('player,can_be_voted,allowed_votes,mod_to_lynch,hidden_mod,allowed_vote_requests\n')
+        vote_config.write('no_lynch,1,0,0,0,0\n')
+
+        for player in PLAYERS:
+            vote_config.write(f'{player},1,1,0,0,0\n')
+
+
+def run_tick(bot:mafia_bot.MafiaBot, client:http_client.HttpClient, label:str) -> dict:
+    '''
+    Runs and measures a single bot tick.
+    '''
+
+    before = client.get_stats()
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    with ParseTimer() as parse_timer:
+        start = time.perf_counter()
+        bot.tick()
+        bot.post_queue.wait_idle()
+        wall  = time.perf_counter() - start
+
+    after = client.get_stats()
+
+    return {'tick': label,
+            'wall_seconds': round(wall, 4),
+            'requests': after['requests'] - before['requests'],
+            'cache_hits': after['cache_hits'] - before['cache_hits'],
+            'bytes': after['bytes'] - before['bytes'],
+            'parse_seconds': round(parse_timer.seconds, 4),
+            'pages_parsed': parse_timer.pages,
+            'peak_memory_kb': tracemalloc.get_traced_memory()[1] // 1024 if tracemalloc.is_tracing() else 0}
+
+
+def benchmark_thread(pages:int, use_cache:bool=True, incremental_posts:int=10) -> list:
+    '''
+    Benchmarks a thread of a given number of pages: a cold catch-up tick,
+    a tick with no new posts, a tick with a few new posts and a restart
+    from the checkpoint.
+
+    Returns:
+    A list of per-tick result dicts.
+    '''
+
+    with tempfile.TemporaryDirectory() as work_dir:
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), None)
+        thread_url = f'http://127.0.0.1:{server.server_address[1]}/foro/mafia/partida-benchmark-{THREAD_ID}'
+
+        forum = StubForum(thread_url)
+        forum.populate(pages)
+
+        server.RequestHandlerClass = make_handler(forum)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        vote_config_path = os.path.join(work_dir, 'vote_config.csv')
+        write_vote_config(vote_config_path)
+
+        cache = page_cache.PageCache(os.path.join(work_dir, 'page_cache')) if use_cache else None
+        store_path = os.path.join(work_dir, 'state.db')
+
+        def build_bot():
+            client = http_client.HttpClient(page_cache=cache)
+            bot    = mafia_bot.MafiaBot(game_url=thread_url,
+                                        game_master=GAME_MASTER,
+                                        bot_userID=BOT_ID,
+                                        bot_password='',
+                                        loop_waittime_seconds=60,
+                                        post_push_interval=10,
+                                        client=client,
+                                        store=state_store.StateStore(store_path),
+                                        forum_session=StubSession(forum),
+                                        vote_config_path=vote_config_path,
+                                        outbound=post_queue.PostQueue(min_spacing_seconds=0))
+            return bot, client
+
+        results = []
+
+        try:
+            bot, client = build_bot()
+
+            results.append(run_tick(bot, client, 'cold'))
+            results.append(run_tick(bot, client, 'idle'))
+
+            forum.add_activity(incremental_posts)
+            results.append(run_tick(bot, client, f'+{incremental_posts} posts'))
+
+            bot, client = build_bot()
+            forum.add_activity(incremental_posts)
+            results.append(run_tick(bot, client, 'restart'))
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        for result in results:
+            result['pages'] = pages
+
+        return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Offline MafiaBot benchmark')
+    parser.add_argument('--pages', type=int, nargs='+', default=[10, 100, 1000],
+                        help='thread sizes, in pages, to benchmark')
+    parser.add_argument('--parsers', nargs='+', default=['auto'], choices=('auto',) + thread_parser.PARSER_BACKENDS,
+                        help='HTML parser backends to benchmark')
+    parser.add_argument('--parse-workers', type=int, nargs='+', default=[0],
+                        help='parser process counts to benchmark, 0 parses in the bot process')
+    parser.add_argument('--no-cache', action='store_true', help='disable the on-disk page cache')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace peak memory')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    if not args.no_memory:
+        tracemalloc.start()
+
+    results = []
+
+    for backend in args.parsers:
+
+        thread_parser.set_backend(backend)
+
+        for workers in args.parse_workers:
+
+            thread_parser.set_parse_workers(workers)
+
+            for pages in args.pages:
+                for result in benchmark_thread(pages, use_cache=not args.no_cache):
+                    result['parser']  = thread_parser.backend
+                    result['workers'] = workers
+                    results.append(result)
+
+    thread_parser.shutdown_parse_pool()
+
+    print()
+    print(f"{'parser':>11} {'workers':>7} {'pages':>6} {'tick':>10} {'wall s':>9} {'requests':>9} {'cached':>7} {'KB':>9} {'parse s':>9} {'parsed':>7} {'peak KB':>9}")
+
+    for result in results:
+        print(f"{result['parser']:>11} {result['workers']:>7} {result['pages']:>6} {result['tick']:>10} {result['wall_seconds']:>9.3f} {result['requests']:>9} "
+              f"{result['cache_hits']:>7} {result['bytes'] // 1024:>9} {result['parse_seconds']:>9.3f} "
+              f"{result['pages_parsed']:>7} {result['peak_memory_kb']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
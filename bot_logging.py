@@ -0,0 +1,147 @@
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+# Every logger of the bot hangs from this one, subsystems are its children:
+# mafia_bot.bot, mafia_bot.http, mafia_bot.post, mafia_bot.orchestrator,
+# mafia_bot.rights, mafia_bot.parser, mafia_bot.metrics, mafia_bot.replay
+# and mafia_bot.main
+ROOT_LOGGER = 'mafia_bot'
+
+# Context attributes copied from log records into the JSON lines
+CONTEXT_FIELDS = ('game', 'day', 'tick', 'post_id')
+
+
+def get_logger(subsystem:str) -> logging.Logger:
+    '''
+    Returns the logger of a bot subsystem.
+    '''
+
+    return logging.getLogger(f'{ROOT_LOGGER}.{subsystem}')
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats records as single line JSON objects carrying the game, day, tick
+    and post id when the record has them.
+    '''
+
+    def format(self, record:logging.LogRecord) -> str:
+
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler that keeps the traceback of a record apart from its
+    message. The standard one formats the traceback into the message and
+    drops it, so it would never reach the exception field of the JSON lines.
+    '''
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+
+        record = copy.copy(record)
+
+        # Merge the arguments now, they may not outlive the call. The
+        # traceback is formatted to text, traceback objects keep whole
+        # frames alive.
+        record.msg  = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+def parse_levels(levels:str) -> dict:
+    '''
+    Parses a per subsystem level list such as "bot=INFO http=WARNING".
+    A bare level sets the level of every subsystem.
+
+    Returns:
+    A subsystem -> level name dict, '' being the key for every subsystem.
+    '''
+
+    parsed = {}
+
+    for item in levels.split():
+
+        subsystem, _, level = item.rpartition('=')
+        level = level.upper()
+
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f'Unknown log level {level} in {item}')
+
+        parsed[subsystem] = level
+
+    return parsed
+
+
+def setup_logging(path:str='mafia.log', levels:str='DEBUG', max_bytes:int=10 * 1024 * 1024,
+                  backup_count:int=5, rotate_when:str='') -> logging.handlers.QueueListener:
+    '''
+    Sets up non blocking logging. Loggers only put records on a queue, a
+    background listener formats them as JSON lines and writes them to a
+    rotating log file.
+
+    Parameters:
+    path (str): The log file.
+    levels (str): Per subsystem levels, see parse_levels.
+    max_bytes (int): Size based rotation threshold. Ignored when rotate_when is set.
+    backup_count (int): Rotated files to keep.
+    rotate_when (str): Time based rotation interval, as in
+    logging.handlers.TimedRotatingFileHandler ('midnight', 'H', ...). Empty
+    for size based rotation.
+
+    Returns:
+    The running QueueListener. Call its stop method before exiting to flush
+    pending records.
+    '''
+
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when,
+                                                                 backupCount=backup_count, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                            backupCount=backup_count, encoding='utf-8')
+
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    listener  = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers = [RecordQueueHandler(log_queue)]
+    root.setLevel(logging.WARNING)
+
+    parsed = parse_levels(levels)
+
+    logging.getLogger(ROOT_LOGGER).setLevel(parsed.pop('', 'DEBUG'))
+
+    for subsystem, level in parsed.items():
+        get_logger(subsystem).setLevel(level)
+
+    listener.start()
+
+    return listener
@@ -0,0 +1,307 @@
+import collections
+import concurrent.futures
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import bot_logging
+import metrics
+import page_cache
+
+logger = bot_logging.get_logger('http')
+
+
+class CircuitOpenError(requests.RequestException):
+    '''
+    Raised without touching the network while the circuit breaker is open.
+    '''
+
+
+class HttpClient:
+    '''
+    Shared fetch layer for every mediavida page access. It keeps a pooled
+    keep-alive session, retries transient failures with exponential backoff
+    and jitter, stops hammering the site through a circuit breaker when it
+    keeps failing and tracks latency and byte counters for each call.
+    '''
+
+    # Status codes worth retrying. Anything else is returned or raised as is.
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, connect_timeout:float=5, read_timeout:float=20,
+                 max_retries:int=3, backoff_base:float=1, backoff_max:float=30,
+                 breaker_threshold:int=5, breaker_cooldown:float=120,
+                 pool_size:int=10, page_cache:page_cache.PageCache=None,
+                 fetch_workers:int=4, max_per_host:int=4):
+
+        self.timeout           = (connect_timeout, read_timeout)
+        self.max_retries       = max_retries
+        self.backoff_base      = backoff_base
+        self.backoff_max       = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown  = breaker_cooldown
+        self.page_cache        = page_cache
+        self.fetch_workers     = fetch_workers
+        self.max_per_host      = max_per_host
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'mv_mafia_bot'
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock                 = threading.Lock()
+        self._consecutive_failures = 0
+        self._breaker_open_until   = 0
+
+        # Concurrent fetches share a worker pool and a connection limit per host
+        self._executor             = None
+        self._host_slots           = {}
+
+        # Per-call records (url, status, seconds, bytes) of the most recent calls
+        self.calls = collections.deque(maxlen=1000)
+        self.reset_stats()
+
+
+    def get(self, url:str, headers:dict=None) -> requests.Response:
+        '''
+        Performs a GET request through the pooled session. Connection errors,
+        timeouts and retryable status codes are retried up to max_retries times.
+
+        Parameters:
+        url (str): The URL to request.
+        headers (dict): Optional extra request headers.
+
+        Returns:
+        A requests.Response object.
+        '''
+
+        self.check_breaker(url)
+
+        attempt = 0
+
+        while True:
+
+            start = time.perf_counter()
+
+            try:
+                with self.get_host_slot(url):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+                error    = None
+
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                response = None
+                error    = exc
+
+            self.record_call(url, response, time.perf_counter() - start)
+
+            retryable = error is not None or response.status_code in self.RETRY_STATUS
+
+            if not retryable:
+                self.record_success()
+                response.raise_for_status()
+                return response
+
+            if attempt >= self.max_retries:
+                self.record_failure(url)
+
+                if error is not None:
+                    raise error
+
+                response.raise_for_status()
+
+            delay = self.get_backoff(attempt)
+            logger.warning(f'Request to {url} failed ({error or response.status_code}). Retrying in {delay:.1f} seconds.')
+
+            with self._lock:
+                self.stats['retries'] += 1
+
+            metrics.REGISTRY.inc('http_retries_total')
+
+            attempt += 1
+            time.sleep(delay)
+
+
+    def get_text(self, url:str, max_age:float=None) -> str:
+        '''
+        Returns the decoded body of a GET request.
+
+        If a page cache is configured and max_age is given, the cached copy is
+        served straight from disk while it is younger than max_age seconds.
+        Older copies are revalidated with If-None-Match/If-Modified-Since.
+        A max_age of 0 always revalidates.
+
+        Parameters:
+        url (str): The URL to request.
+        max_age (float): Seconds a cached copy is trusted without asking the
+        server. None skips the cache.
+
+        Returns:
+        The page body as a string.
+        '''
+
+        if self.page_cache is None or max_age is None:
+            return self.get(url).text
+
+        entry = self.page_cache.get(url)
+        headers = {}
+
+        if entry is not None:
+
+            if time.time() - entry['fetched_at'] < max_age:
+                with self._lock:
+                    self.stats['cache_hits'] += 1
+
+                metrics.REGISTRY.inc('http_cache_hits_total')
+                return entry['body']
+
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.get(url, headers=headers)
+
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self.stats['not_modified'] += 1
+
+            metrics.REGISTRY.inc('http_not_modified_total')
+
+            self.page_cache.touch(url, entry)
+            return entry['body']
+
+        self.page_cache.store(url, response.text,
+                              etag=response.headers.get('ETag'),
+                              last_modified=response.headers.get('Last-Modified'))
+
+        return response.text
+
+
+    def get_many(self, requests_to_do:list) -> list:
+        '''
+        Downloads several pages concurrently using a bounded worker pool, while
+        keeping at most max_per_host connections open to the same host.
+
+        Parameters:
+        requests_to_do (list): A list of (url, max_age) tuples, see get_text.
+
+        Returns:
+        A list of page bodies in the same order as requests_to_do. If any
+        download fails, its exception is raised once all the others are done.
+        '''
+
+        if len(requests_to_do) <= 1 or self.fetch_workers <= 1:
+            return [self.get_text(url, max_age=max_age) for url, max_age in requests_to_do]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers,
+                                                                       thread_name_prefix='fetch')
+
+        futures = [self._executor.submit(self.get_text, url, max_age) for url, max_age in requests_to_do]
+
+        concurrent.futures.wait(futures)
+
+        return [future.result() for future in futures]
+
+
+    def get_host_slot(self, url:str) -> threading.BoundedSemaphore:
+        '''
+        Returns the semaphore limiting the open connections to the host of url.
+        '''
+
+        host = urllib.parse.urlsplit(url).netloc
+
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+
+            return self._host_slots[host]
+
+
+    def get_backoff(self, attempt:int) -> float:
+        '''
+        Exponential backoff with full jitter for a given retry attempt.
+        '''
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+    def check_breaker(self, url:str):
+        '''
+        Raises CircuitOpenError if the breaker is open. Once the cooldown is
+        over, requests are let through again and the next result decides
+        whether the breaker closes or opens again.
+        '''
+
+        with self._lock:
+
+            if time.monotonic() < self._breaker_open_until:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError(f'Circuit breaker open, not requesting {url}')
+
+
+    def record_success(self):
+
+        with self._lock:
+            self._consecutive_failures = 0
+
+
+    def record_failure(self, url:str):
+
+        metrics.REGISTRY.inc('http_failures_total')
+
+        with self._lock:
+            self.stats['failures']     += 1
+            self._consecutive_failures += 1
+
+            if self._consecutive_failures >= self.breaker_threshold:
+                self._breaker_open_until = time.monotonic() + self.breaker_cooldown
+                logger.error(f'{self._consecutive_failures} consecutive failed requests (last: {url}). '
+                             f'Opening circuit breaker for {self.breaker_cooldown} seconds.')
+
+
+    def record_call(self, url:str, response, seconds:float):
+
+        status = response.status_code if response is not None else None
+        size   = len(response.content) if response is not None else 0
+
+        with self._lock:
+            self.calls.append((url, status, seconds, size))
+            self.stats['requests']        += 1
+            self.stats['bytes']           += size
+            self.stats['latency_seconds'] += seconds
+            self.stats['max_latency']      = max(self.stats['max_latency'], seconds)
+
+        metrics.REGISTRY.inc('http_requests_total')
+        metrics.REGISTRY.inc('http_bytes_total', size)
+        metrics.REGISTRY.observe('http_request_seconds', seconds)
+
+
+    def get_stats(self) -> dict:
+        '''
+        Returns a copy of the accumulated counters.
+        '''
+
+        with self._lock:
+            return dict(self.stats)
+
+
+    def reset_stats(self):
+
+        with self._lock:
+            self.stats = {'requests': 0,
+                          'retries': 0,
+                          'failures': 0,
+                          'rejected': 0,
+                          'bytes': 0,
+                          'cache_hits': 0,
+                          'not_modified': 0,
+                          'latency_seconds': 0.0,
+                          'max_latency': 0.0}
@@ -1,418 +1,1484 @@
+import collections
+import functools
+import hashlib
 import logging
 import math
+import re
 import requests
 import time
-import re
 
-from bs4 import BeautifulSoup
 import pandas as pd
 
+import bot_logging
+import http_client
+import metrics
+import phase_index
+import post_queue
+import scheduler
+import state_store
+import thread_parser
 import user
+import vote_ledger
+import vote_rights
+
+# What to do when a counted post is edited and its commands change:
+# ignore keeps the count as it was, report keeps it and lists the post in
+# the next vote count, honour counts the edited commands
+EDIT_POLICIES = ('ignore', 'report', 'honour')
 
 class MafiaBot:
 
     def __init__(self, game_url: str, game_master: str,
                  bot_userID:str, bot_password:str, loop_waittime_seconds:int,
-                 post_push_interval:int):
+                 post_push_interval:int, client:http_client.HttpClient=None,
+                 page_revalidate_seconds:int=3600, store:state_store.StateStore=None,
+                 forum_session:user.ForumSession=None,
+                 vote_config_path:str='vote_config.csv',
+                 min_update_time_seconds:int=None, max_update_time_seconds:int=None,
+                 watch_interval_seconds:int=None, outbound:post_queue.PostQueue=None,
+                 edit_policy:str='ignore'):
 
 
         self.game_thread           = game_url
         self.thread_id             = int(game_url.split('-')[-1])
+
+        # Every log record of this bot carries the game, and the current tick,
+        # day and post when known
+        self.log_context           = {'game': self.thread_id, 'tick': 0, 'day': None, 'post_id': None}
+        self.log                   = logging.LoggerAdapter(bot_logging.get_logger('bot'), self.log_context)
         self.game_master           = game_master
         self.bot_ID                = bot_userID
         self.bot_password          = bot_password
         self.post_push_interval    = post_push_interval
+        self.update_tick           = loop_waittime_seconds
+
+        # Polling interval adapts to thread activity within these bounds
+        self.poller                = scheduler.AdaptivePoller(base_interval=loop_waittime_seconds,
+                                                              min_interval=min_update_time_seconds or loop_waittime_seconds,
+                                                              max_interval=max_update_time_seconds or loop_waittime_seconds)
+        self.activity              = {}
+        self.vote_config_path      = vote_config_path
+
+        # Between full iterations the last page is polled at this interval
+        # for GM vote count requests and votes that may reach majority.
+        # None or 0 disables the watcher.
+        self.watch_interval        = watch_interval_seconds
+        self._watch_bodies         = {} # url -> (body, ThreadPage) of the last watch
+
+        # Every mediavida page access goes through this shared client
+        self.http_client           = client or http_client.HttpClient()
+
+        # Authenticated posting client, built on the first push and then reused
+        self.forum_session         = forum_session
+        self.poster                = None
+
+        # Posts are sent by the outbound queue worker. Its results are
+        # collected here and applied at the start of the next iteration.
+        self.post_queue            = outbound or post_queue.PostQueue()
+        self._posted               = collections.deque()
+
+        # A lynch announcement not posted yet. It is checkpointed, so it is
+        # queued again if the bot restarts before it was sent.
+        self.pending_lynch         = None
+
+        # How long full (immutable) thread pages are served from the page cache
+        self.page_revalidate_seconds = page_revalidate_seconds
+
+        # Persistent bot state shared across restarts
+        self.state_store             = store or state_store.StateStore()
+
+        self.current_day_start_post  = 1
+
+        # The bot keeps track of the vote counts it pushes. Scraping the bot
+        # posts is only needed once at startup to reconcile this state.
+        self.last_votecount_id       = 1
+        self.last_votecount_final    = False
+        self.votecount_reconciled    = False
+
+        # Fingerprint of the vote table of the last pushed vote count, so an
+        # identical count is not posted again
+        self.last_pushed_fingerprint = None
+
+        self.player_list              = []
+
+        # Known phase transitions, so GM pages are not rescanned every tick
+        self.phase_index              = phase_index.PhaseIndex()
+
+        # Incremental counting cursor. The vote ledger is kept between ticks
+        # and only posts newer than last_processed_post are applied to it.
+        self.vote_ledger              = vote_ledger.VoteLedger()
+        self.last_processed_post      = 1
+        self.counted_day_start_post   = 0
+        self.counted_player_list      = []
+
+        # Edit detection. Counted posts of the page the count resumes from
+        # keep their content hash, and every counted post with commands keeps
+        # them, so the day can be counted again from memory.
+        if edit_policy not in EDIT_POLICIES:
+            raise ValueError(f'Unknown edit policy {edit_policy}, expected one of {", ".join(EDIT_POLICIES)}')
+
+        self.edit_policy              = edit_policy
+        self.post_hashes              = {} # post id -> content hash
+        self.day_commands             = {} # post id -> (author, commands), in post order
+        self.reported_edits           = [] # edited post ids for the next vote count
+
+        self._tick_pages              = {}
+
+        # Page count and last post of the thread, read once per iteration.
+        # The page count of the previous iteration says which page to read
+        # them from.
+        self.thread_snapshot          = None
+        self.last_known_page          = 1
+
+        # Load vote rights table, keyed by lowercase player names. It is
+        # reloaded when the file changes and shared with the posting client.
+        self.vote_rights = vote_rights.VoteRights(self.vote_config_path)
+
+        self.vote_requests = pd.DataFrame({'vote_requested': []}, dtype=int)
+
+        self.build_rights_tables()
+
+
+        self.majority_reached         = False
+
+        # Temporal fix until proper votecount request queue is implemented
+        self.gm_vote_request          = False
+
+        # Resume from the last checkpoint, if any
+        self.restore_checkpoint()
+
+        print('Mafia MV Bot started!')
+        print('Game run by:', game_master)
+        print('Bot ID is', self.bot_ID)
+
+        self.log.info(f'Bot started. Game run by {game_master}. Bot id is: {self.bot_ID}')
+
+    
+    def run(self, update_tick:int=None):
+        '''
+        Main bot loop for a standalone bot. It iterates each N seconds,
+        as defined by the config file. For each iteration, it parses the game
+        thread if we are on day phase, then counts all the votes and decides
+        if a new vote count should be pushed.
+
+        Several games can be run in the same process with orchestrator.Orchestrator
+        instead, which calls run_tick on each bot.
+
+        Parameters: 
+        update_tick (int): Seconds to pass between bot iterations. If not
+        given, the interval adapts to the thread activity.
+
+        Returns: None
+        '''
+
+        while(True):
+
+            self.run_tick()
+
+            self._wait = update_tick if update_tick is not None else self.get_next_interval()
+
+            self.log.info(f'Sleeping for {self._wait:.0f} seconds.')  
+
+            print(f'Sleeping for {self._wait:.0f} seconds.')
+            self.wait_and_watch(self._wait)
+
+
+    def wait_and_watch(self, wait:float):
+        '''
+        Sleeps until the next iteration is due, running the last page watcher
+        in between when enabled. Returns early if the watcher finds something
+        that needs an immediate iteration.
+
+        Parameters:
+        wait (float): Seconds until the next iteration.
+
+        Returns: None
+        '''
+
+        self._wake_at = time.monotonic() + wait
+
+        while True:
+
+            self._remaining = self._wake_at - time.monotonic()
+
+            if self._remaining <= 0:
+                return
+
+            if not self.should_watch():
+                time.sleep(self._remaining)
+                return
+
+            time.sleep(min(self.watch_interval, self._remaining))
+
+            if time.monotonic() < self._wake_at and self.run_watch():
+                return
+
+
+    def run_tick(self):
+        '''
+        Runs a single iteration, making sure a network failure does not
+        stop the bot.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        try:
+            self.tick()
+
+        # Network failures are already retried by the http client. If we
+        # still fail, give up on this iteration and try again later.
+        except requests.RequestException as e:
+            metrics.REGISTRY.inc('tick_errors_total', game=self.thread_id)
+            self.log.error(f'Iteration of thread {self.thread_id} aborted due to a network error: {e}')
+            print('Network error, skipping this iteration.')
+
+        self.log.info(f'HTTP stats: {self.http_client.get_stats()}')
+
+
+    def should_watch(self) -> bool:
+        '''
+        The last page watcher only runs during a day with no majority yet,
+        once a full iteration has located the current day.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether the watcher should run.
+        '''
+
+        return bool(self.watch_interval) and self.phase_index.is_built() \
+               and self.phase_index.is_day() and not self.majority_reached
+
+
+    def run_watch(self) -> bool:
+        '''
+        Runs the last page watcher, making sure a network failure does not
+        stop the bot.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether a full iteration should run right away.
+        '''
+
+        try:
+            self._watch_trigger = self.watch_last_page()
+
+        except requests.RequestException as e:
+            self.log.warning(f'Last page watch of thread {self.thread_id} failed: {e}')
+            return False
+
+        metrics.REGISTRY.inc('watch_checks_total', game=self.thread_id)
+
+        if self._watch_trigger:
+            metrics.REGISTRY.inc('watch_triggers_total', game=self.thread_id)
+
+        return self._watch_trigger
+
+
+    def watch_last_page(self) -> bool:
+        '''
+        Cheap check of the posts newer than the counting cursor. Only the page
+        holding the cursor, and the next one if it exists, are revalidated with
+        a conditional request and nothing is counted here: the watcher just
+        decides whether the full iteration should run now. That is the case
+        when the GM asked for a vote count or when the new votes may give
+        some player the majority.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether a full iteration should run right away.
+        '''
+
+        self._watch_page  = self.get_page_number_from_post(self.last_processed_post)
+        self._watch_posts = []
+
+        watched = {}
+
+        for self._watch_url in (self.get_thread_page_url(self._watch_page),
+                                self.get_thread_page_url(self._watch_page + 1)):
+
+            body = self.http_client.get_text(self._watch_url, max_age=0)
+
+            # Only parse the page again if it changed since the last watch
+            if self._watch_bodies.get(self._watch_url, (None,))[0] == body:
+                watched[self._watch_url] = self._watch_bodies[self._watch_url]
+            else:
+                watched[self._watch_url] = (body, thread_parser.parse_page(body))
+
+            parsed = watched[self._watch_url][1]
+            self._watch_posts.extend(parsed.posts)
+
+            if parsed.page_count <= self._watch_page:
+                break
+
+        self._watch_bodies = watched
+
+        pending_votes = {}
+
+        for post in self._watch_posts:
+
+            if post.post_id <= self.last_processed_post:
+                continue
+
+            for command in post.commands:
+
+                if command == 'recuento' and post.author == self.game_master.lower() \
+                   and post.post_id > self.last_votecount_id:
+
+                    self.log.info(f'Watcher found a GM vote count request at {post.post_id}')
+                    return True
+
+                if command.startswith('voto'):
+
+                    victim = 'no_lynch' if command.endswith('no linchamiento') else command.split(' ')[-1]
+                    pending_votes[victim] = pending_votes.get(victim, 0) + 1
+
+                    if self.could_reach_majority(victim, pending_votes[victim]):
+                        self.log.info(f'Watcher found a vote at {post.post_id} that may lynch {victim}')
+                        return True
+
+        return False
+
+
+    def could_reach_majority(self, victim:str, pending_votes:int) -> bool:
+        '''
+        Checks if a number of votes not yet counted could be enough to lynch
+        a player. Validity is not checked, that is left to the full count.
+
+        Parameters:
+        victim (str): The voted player.
+        pending_votes (int): New votes for that player.
+
+        Returns:
+        True/False (bool): Whether those votes may reach the majority.
+        '''
+
+        if victim not in self.vote_rights:
+            return False
+
+        if victim != 'no_lynch' and victim not in self.player_list:
+            return False
+
+        self._missing = (self.get_vote_majority() + self.vote_rights.get(victim, 'mod_to_lynch')
+                         - self.vote_ledger.get_vote_count(victim))
+
+        return pending_votes >= self._missing
+
+
+    def get_next_interval(self) -> float:
+        '''
+        Seconds to wait before the next iteration, based on the activity
+        found by the last one.
+
+        Parameters: None
+
+        Returns:
+        The wait in seconds.
+        '''
+
+        self._next_interval = self.poller.next_interval(self.activity)
+
+        self.log.info(f'Last iteration activity: {self.activity}. Next check in {self._next_interval:.0f} seconds.')
+
+        return self._next_interval
+    
+
+    def tick(self):
+        '''
+        A single bot iteration: detects the game phase, counts the new votes
+        and pushes a vote count if needed.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        # Every page is downloaded and parsed at most once per iteration
+        self._tick_pages = {}
+        self.thread_snapshot = None
+
+        self.apply_posted()
+        self.reload_vote_rights()
+
+        self.log_context['tick']   += 1
+        self.log_context['post_id'] = None
+
+        # Per tick instrumentation
+        self._tick_started = time.perf_counter()
+        self._http_before  = self.http_client.get_stats()
+        self.tick_timings  = {'phase_seconds': 0.0,
+                              'parse_seconds': 0.0,
+                              'pages_parsed': 0}
+
+        # What this iteration found, used to schedule the next one
+        self.activity    = {'day': False,
+                            'majority_reached': self.majority_reached,
+                            'new_posts': 0,
+                            'new_votes': 0,
+                            'votes_to_majority': None}
+
+        self.run_day_count()
+
+        self.activity['majority_reached'] = self.majority_reached
+
+        if self.activity['day']:
+            self.activity['votes_to_majority'] = self.get_votes_to_majority()
+
+        self.save_checkpoint()
+
+        self.record_tick_metrics()
+
+
+    def record_tick_metrics(self):
+        '''
+        Publishes the timings and counters of the iteration that just ended
+        to the metrics registry.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        self._http_after   = self.http_client.get_stats()
+        self._tick_seconds = time.perf_counter() - self._tick_started
+
+        self._summary = dict(self.activity,
+                             game=self.thread_id,
+                             tick_seconds=self._tick_seconds,
+                             requests=self._http_after['requests'] - self._http_before['requests'],
+                             cache_hits=self._http_after['cache_hits'] - self._http_before['cache_hits'],
+                             not_modified=self._http_after['not_modified'] - self._http_before['not_modified'],
+                             bytes=self._http_after['bytes'] - self._http_before['bytes'],
+                             http_seconds=self._http_after['latency_seconds'] - self._http_before['latency_seconds'],
+                             **self.tick_timings)
+
+        metrics.REGISTRY.observe('tick_seconds', self._tick_seconds, game=self.thread_id)
+        metrics.REGISTRY.observe('phase_detection_seconds', self.tick_timings['phase_seconds'], game=self.thread_id)
+        metrics.REGISTRY.inc('ticks_total', game=self.thread_id)
+        metrics.REGISTRY.set('last_processed_post', self.last_processed_post, game=self.thread_id)
+        metrics.REGISTRY.set('majority_reached', int(self.majority_reached), game=self.thread_id)
+        metrics.REGISTRY.record_tick(self._summary)
+
+
+    def run_day_count(self):
+        '''
+        Counts the new votes of the current day, if we are on day phase, and
+        pushes a vote count if needed.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        self._phase_started = time.perf_counter()
+        self._is_day        = self.is_day_phase()
+
+        self.tick_timings['phase_seconds'] = time.perf_counter() - self._phase_started
+
+        if self._is_day: # Daytime, count
+
+            print('We are on day time!')
+
+            self.activity['day'] = True
+
+            self.check_last_votecount()
+
+            if not self.majority_reached:
+
+                self.last_thread_post  = self.get_last_post()
+
+                if not self.is_vote_state_valid():
+                    self.reset_vote_state()
+
+                self.log.info(f'Starting vote count. Last vote count: {self.last_votecount_id}. Last reply: {self.last_thread_post}')
+
+                # Resume from the page of the last post we already counted, so
+                # edits of its counted posts are noticed
+                self._start_page = self.get_page_number_from_post(self.last_processed_post)
+                self._page_count = self.request_page_count()
+
+                self.log.info(f'Detected day start at page: {self.get_page_number_from_post(self.current_day_start_post)}')
+                self.log.info(f'Resuming count from post {self.last_processed_post} at page: {self._start_page}')
+                self.log.info(f'Detected {self._page_count} pages')
+
+                # Pages are streamed in small concurrent batches and applied in
+                # post order, so memory does not grow with the pages to count
+                for self._post in self.iter_new_posts(self._start_page, self._page_count):
+
+                    self.count_post(self._post)
+
+                    # Persist every processed page, a restart resumes from here
+                    if self._post.post_id % 30 == 0:
+                        self.save_checkpoint()
+
+                self.save_checkpoint()
+
+                self.log.info('Finished counting.')
+                print('Finished counting')
+
+                # The lynch announcement is the last count of the day
+                if self.majority_reached:
+                    self.gm_vote_request = False
+                    self.log.info('Majority reached during this count. No regular vote count is pushed.')
+
+                elif self.update_thread_vote_count():
+
+                    self.log.info('Pushing a new votecount')
+                    self.push_vote_count()  
+                
+                else:
+                    self.log.info('Recent votecount detected. ')
+            
+            else:
+                self.log.info('Majority already reached. Skipping...')
+                
+        else:
+            self.log.info('Night phase detected. Skipping...')
+            print('We are on night phase!')
+
+
+    def save_checkpoint(self):
+        '''
+        Writes the whole bot state to the state store in a single transaction.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        self.state_store.save_checkpoint(self.thread_id, {
+            'current_day_start_post': self.current_day_start_post,
+            'player_list': self.player_list,
+            'phase_index': self.phase_index.to_dict(),
+            'last_votecount_id': self.last_votecount_id,
+            'last_votecount_final': self.last_votecount_final,
+            # A vote count still in the queue may never be posted, so the bot
+            # posts are scraped again after a restart
+            'votecount_reconciled': self.votecount_reconciled and not self.post_queue.is_pending(self.thread_id, 'votecount'),
+            'pending_lynch': self.pending_lynch,
+            'last_pushed_fingerprint': self.last_pushed_fingerprint,
+            'votes': self.vote_ledger.to_records(),
+            'last_processed_post': self.last_processed_post,
+            'last_known_page': self.last_known_page,
+            'counted_day_start_post': self.counted_day_start_post,
+            'counted_player_list': self.counted_player_list,
+            'post_hashes': self.post_hashes,
+            'day_commands': [[post_id, author, list(commands)] for post_id, (author, commands) in self.day_commands.items()],
+            'reported_edits': self.reported_edits,
+            'majority_reached': self.majority_reached,
+            'gm_vote_request': self.gm_vote_request,
+            'vote_requests': self.vote_requests['vote_requested'].astype(int).to_dict()})
+
+
+    def restore_checkpoint(self):
+        '''
+        Loads the bot state from the last checkpoint of this game, so only the
+        posts newer than the checkpoint need to be processed after a restart.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        checkpoint = self.state_store.load_checkpoint(self.thread_id)
+
+        if checkpoint is None:
+            self.log.info('No checkpoint found. Starting from scratch.')
+            return
+
+        self.current_day_start_post = checkpoint['current_day_start_post']
+        self.player_list            = checkpoint['player_list']
+        self.phase_index            = phase_index.PhaseIndex.from_dict(checkpoint['phase_index'])
+        self.last_votecount_id      = checkpoint['last_votecount_id']
+        self.last_votecount_final   = checkpoint['last_votecount_final']
+        self.votecount_reconciled   = checkpoint['votecount_reconciled']
+        self.vote_ledger            = vote_ledger.VoteLedger.from_records(checkpoint['votes'])
+        self.last_processed_post    = checkpoint['last_processed_post']
+        self.last_known_page        = checkpoint.get('last_known_page', 1)
+        self.counted_day_start_post = checkpoint['counted_day_start_post']
+        self.counted_player_list    = checkpoint['counted_player_list']
+        self.majority_reached       = checkpoint['majority_reached']
+        self.gm_vote_request        = checkpoint['gm_vote_request']
+        self.pending_lynch          = checkpoint.get('pending_lynch')
+        self.last_pushed_fingerprint = checkpoint.get('last_pushed_fingerprint')
+        self.post_hashes            = {int(post_id): content_hash
+                                       for post_id, content_hash in checkpoint.get('post_hashes', {}).items()}
+        self.day_commands           = {post_id: (author, tuple(commands))
+                                       for post_id, author, commands in checkpoint.get('day_commands', [])}
+        self.reported_edits         = checkpoint.get('reported_edits', [])
+
+        # Checkpoints without the commands of the day can not recount it from
+        # memory, count the day again once
+        if 'day_commands' not in checkpoint:
+            self.counted_day_start_post = 0
+
+        self.vote_requests['vote_requested'] = [checkpoint['vote_requests'].get(player, 0)
+                                                for player in self.vote_requests.index]
+
+        self.log.info(f'Resumed from checkpoint at post {self.last_processed_post}')
+
+        if self.pending_lynch is not None:
+            self.log.info(f"Queueing again the lynch announcement of {self.pending_lynch['victim']}")
+            self.queue_lynch()
+
+
+    def build_rights_tables(self):
+        '''
+        Builds the real names and vote requests tables from the vote rights
+        table. Vote requests already made are kept.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        # We'll use this table as the master table for real names
+        self.real_names = self.vote_rights.get_real_names()
+        self.real_names[self.game_master.lower()] = 'GM'
+
+        self._players = list(self.vote_rights.rights)
+
+        self.vote_requests = pd.DataFrame({'player': [self.real_names[player] for player in self._players],
+                                           'max_vote_requests': [self.vote_rights.get(player, 'allowed_vote_requests')
+                                                                 for player in self._players],
+                                           'vote_requested': [self.vote_requests['vote_requested'].get(player, 0)
+                                                              for player in self._players]},
+                                          index=self._players)
+
+
+    def reload_vote_rights(self):
+        '''
+        Picks up changes of the vote rights file. Votes of the current day are
+        evaluated again with the new rights, unless the majority was already
+        reached and announced. The ledger is rebuilt from the commands of the
+        day kept in memory, see recount_day_commands.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        if not self.vote_rights.reload_if_changed():
+            return
+
+        self.build_rights_tables()
+
+        if self.majority_reached:
+            self.log.info('Vote rights changed after the majority was reached. The count is not reevaluated.')
+            return
+
+        # Checkpoints written before the commands of the day were kept can
+        # only be counted again from the thread
+        if self.counted_day_start_post != self.current_day_start_post:
+            self.log.info('Vote rights changed. Counting the current day again from the thread.')
+            self.reset_vote_state()
+            return
+
+        self.log.info('Vote rights changed. Counting the current day again.')
+        self.recount_day_commands()
+
+
+    def is_vote_state_valid(self) -> bool:
+        '''
+        Checks if the vote table kept from previous iterations can still be
+        used as the base for an incremental count. It is invalidated when
+        a new day starts, when the GM changes the alive player list or when
+        the cursor points past the last post of the thread (deleted posts).
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether the incremental vote state can be reused.
+        '''
+
+        if self.counted_day_start_post != self.current_day_start_post:
+            return False
+
+        if self.counted_player_list != self.player_list:
+            return False
+
+        if self.last_processed_post > self.last_thread_post:
+            return False
+
+        return True
+
+
+    def reset_vote_state(self):
+        '''
+        Drops the current vote ledger and moves the post cursor back to the
+        start of the current day, forcing a full rescan of the day.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        self.log.info(f'Resetting vote state. Full rescan from post {self.current_day_start_post}')
+
+        self.vote_ledger            = vote_ledger.VoteLedger()
+        self.last_processed_post    = self.current_day_start_post
+        self.counted_day_start_post = self.current_day_start_post
+        self.counted_player_list    = list(self.player_list)
+        self.post_hashes            = {}
+        self.day_commands           = {}
+        self.reported_edits         = []
+
+
+    def is_day_phase(self) -> bool:
+        '''
+        Figures out if the game is currently on day phase using the phase index.
+        The most recent GM phase header decides the phase: "Día N" starts a
+        day and "Final del día N" ends it.
+
+        On the first call the GM posts are scanned from the newest to the
+        oldest until a phase header is found. Later calls only check the GM
+        posts newer than the last one inspected.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether game is on day phase.
+        '''
+
+        if self.phase_index.is_built():
+            self.update_phase_index()
+        else:
+            self.build_phase_index()
+
+        if self.phase_index.is_day():
+
+            self._current_phase = self.phase_index.get_current_phase()
+            self.log_context['day'] = self._current_phase['day']
+
+            # A new day has started
+            if self.current_day_start_post < self._current_phase['start_post']:
+                self.majority_reached = False
+                self.vote_requests['vote_requested'] = 0
+
+            self.current_day_start_post = self._current_phase['start_post']
+            self.player_list            = list(self._current_phase['player_list'])
+
+            return True
+
+        return False
+
+
+    def build_phase_index(self):
+        '''
+        Walks the GM posts from the last page to the first one until the most
+        recent phase header is found, and stores it in the phase index.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        # Get total gm pages
+        self._gm_pages = self.get_page(self.get_user_posts_url(self.game_master, 1)).page_count
+
+        # We'll start looping from the last page to the previous one
+        for self._pagenum in range(self._gm_pages, 0, -1):
+
+            self.prefetch_user_pages(self.game_master, self._pagenum, self._gm_pages)
+
+            self.log.info(f'Looking for phase headers in GM page {self._pagenum}')
+
+            self._posts = self.get_page(self.get_user_posts_url(self.game_master, self._pagenum),
+                                        immutable=self.is_page_immutable(self._pagenum, self._gm_pages)).posts
+          
+            for self._post in reversed(self._posts): # from more recent to older posts
+
+                self.phase_index.mark_seen(self._post.post_id, self._pagenum)
+
+                if thread_parser.get_phase_transition(self._post) is not None:
+                    self.add_phase_transition(self._post)
+                    return
+
+
+    def update_phase_index(self):
+        '''
+        Checks the GM posts newer than the last one inspected for phase
+        headers. Usually this is a single request for the last GM page.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        self._first_page = self.phase_index.last_seen_page
+        self._gm_pages   = self.get_page(self.get_user_posts_url(self.game_master, self._first_page)).page_count
+
+        for self._pagenum in range(self._first_page, max(self._first_page, self._gm_pages) + 1):
+
+            self._posts = self.get_page(self.get_user_posts_url(self.game_master, self._pagenum)).posts
+
+            for self._post in self._posts:
+
+                if self._post.post_id > self.phase_index.last_seen_post:
+
+                    if thread_parser.get_phase_transition(self._post) is not None:
+                        self.add_phase_transition(self._post)
+
+                    self.phase_index.mark_seen(self._post.post_id, self._pagenum)
+
+
+    def add_phase_transition(self, post:thread_parser.PostRecord):
+        '''
+        Stores a GM phase header post in the phase index. For a day start, the
+        alive player list is read from the post once and kept in the index.
+
+        Parameters:
+        post (PostRecord): A GM post with a phase header.
+
+        Returns: None
+        '''
+
+        transition, day = thread_parser.get_phase_transition(post)
+
+        if transition == 'end':
+            self.log.info(f'Detected end of day {day} at post {post.post_id}')
+            self.phase_index.add_day_end(day, post.post_id)
+
+        else:
+            self.log.info(f'Detected start of day {day} at post {post.post_id}')
+            self.phase_index.add_day_start(day, post.post_id, self.get_player_list(post.post_id))
+
+
+    def update_thread_vote_count(self) -> bool:
+        '''
+        Decides if a new vote count should be posted based on:
+        
+        a) Pending GM requests.\n
+        b) How many messages were posted since the last vote count. This is used-defined.
+        In this case the count is only pushed if it differs from the last one.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether to push a new vote count.
+        '''
+
+        self._push = False
+
+        self._posts_since_count = self.last_thread_post - self.last_votecount_id
+
+        if self.gm_vote_request:
+
+            self._push           = True
+            self.gm_vote_request = False
+
+        elif self._posts_since_count >= self.post_push_interval:
+
+            if self.get_votecount_fingerprint() != self.last_pushed_fingerprint:
+                self._push = True
+
+            else:
+                self.log.info('Vote count unchanged since the last push. Skipping...')
+                metrics.REGISTRY.inc('votecount_pushes_skipped_total', game=self.thread_id)
+            
+        return self._push
+
+
+    def get_votecount_fingerprint(self) -> str:
+        '''
+        Hashes what a vote count message shows: the day, the majority, every
+        voted player with their voters, most voted first, and the reported
+        post edits. Messages with the same fingerprint only differ in the last
+        post they cover.
+
+        Parameters: None
+
+        Returns:
+        A short hex digest (str).
+        '''
+
+        # Stable sort, ties keep the order of their first vote
+        self._ranking = sorted(self.vote_ledger.voters_by_victim.items(), key=lambda item: -len(item[1]))
+
+        self._fingerprint_source = repr((self.current_day_start_post,
+                                         len(self.player_list),
+                                         self.get_vote_majority(),
+                                         [(victim, list(voters.values())) for victim, voters in self._ranking],
+                                         self.reported_edits))
+
+        return hashlib.blake2b(self._fingerprint_source.encode('utf-8'), digest_size=8).hexdigest()
+
+
+    def check_last_votecount(self):
+        '''
+        Makes sure self.last_votecount_id is up to date. On the first day
+        iteration after startup (or after a push whose post id could not be
+        read) the bot posts are scraped to reconcile it. Otherwise the locally
+        recorded value is trusted.
+
+        If the last vote count was a final one pushed during the current day,
+        the majority was already reached.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        if not self.votecount_reconciled:
+
+            self.last_votecount_id    = self.get_last_votecount()
+            self.votecount_reconciled = True
+
+        if self.last_votecount_final and self.current_day_start_post < self.last_votecount_id:
+            self.majority_reached = True
+
+
+    def record_votecount(self, post_url:str, final:bool):
+        '''
+        Records a vote count pushed by the bot, using the post id found in the
+        URL returned after posting.
+
+        Parameters:\n
+        post_url (str): The URL the forum redirected to after posting.
+        final (bool): Whether it was a lynch (final) vote count.
+
+        Returns: None
+        '''
+
+        self._post_id = re.findall('#([0-9]+)$', post_url or '')
+
+        if self._post_id:
+            self.last_votecount_id = int(self._post_id[0])
+
+        else:
+            # The vote count is newer than the last post we have seen. Use that
+            # until the bot posts are scraped again on the next iteration.
+            self.log.warning(f'Could not read the post id of the pushed vote count from {post_url}')
+            self.last_votecount_id    = self.last_thread_post
+            self.votecount_reconciled = False
+
+        self.last_votecount_final = final
+
+        self.log.info(f'Recorded vote count at post {self.last_votecount_id}. Final: {final}')
+
+        self.save_checkpoint()
+
+
+    def get_last_votecount(self) -> int:
+        '''
+        Parses the bot messages in the game thread to get the post id of the 
+        last automated vote count pushed.
+    
+        Parameters: None
+
+        Returns:
+        An int representing the post id of the last automated vote count.
+        '''
+
+        self._last_votecount_id   = 1 
+        self.last_votecount_final = False
+        
+        # Get total bot pages
+        self._bot_pages = self.get_page(self.get_user_posts_url(self.bot_ID, 1)).page_count
+
+         # We'll start looping from the last page to the previous one
+        for self._pagenum in range(self._bot_pages, 0, -1):
+
+            self.prefetch_user_pages(self.bot_ID, self._pagenum, self._bot_pages)
+
+            #TODO: log these iterations?
+            self._posts = self.get_page(self.get_user_posts_url(self.bot_ID, self._pagenum),
+                                        immutable=self.is_page_immutable(self._pagenum, self._bot_pages)).posts
+          
+            for self._post in reversed(self._posts): # from more recent to older posts
+
+                self._count_type = thread_parser.get_votecount_type(self._post)
+
+                # Hacky way to cover oddball case of the bot 
+                # shutting down and a player editing after EoD
+                if self._count_type is not None:
+
+                    if self._count_type == 'final' and self.current_day_start_post < self._post.post_id:
+                        self.majority_reached = True
+
+                    self.last_votecount_final = self._count_type == 'final'
+                    self._last_votecount_id   = self._post.post_id
+                    return self._last_votecount_id
+    
+        
+        return self._last_votecount_id
+
+    
+    def get_last_post(self) -> int:
+        '''
+        Parses the game thread messages to get the post id of the 
+        last posted message.
+    
+        Parameters: None
+
+        Returns:
+        An int representing the post id of the last posted message.
+        '''
+
+        return self.get_thread_snapshot().last_post_id
+
+
+    def count_post(self, post:thread_parser.PostRecord):
+        '''
+        Applies a post newer than the counting cursor and moves the cursor
+        past it.
+
+        Parameters:\n
+        post (PostRecord): The post to apply.
+
+        Returns: None
+        '''
+
+        self.process_post(post)
+
+        self.last_processed_post = post.post_id
+        self.activity['new_posts'] = self.activity.get('new_posts', 0) + 1
+
+        self.post_hashes[post.post_id] = post.content_hash
+
+        if post.commands:
+            self.day_commands[post.post_id] = (post.author, post.commands)
+
+
+    def check_edit(self, post:thread_parser.PostRecord):
+        '''
+        Compares an already counted post with the hash it had when it was
+        counted. Every edit is logged and counted in the metrics. Edits that
+        change the commands of the post are then handled by the edit policy.
+
+        Parameters:\n
+        post (PostRecord): A post older than the counting cursor.
+
+        Returns: None
+        '''
 
-        self.current_day_start_post  = 1
-        self.last_votecount_id       = 1
+        if self.post_hashes.get(post.post_id, post.content_hash) == post.content_hash:
+            return
 
-        self.player_list              = []
+        self.post_hashes[post.post_id] = post.content_hash
 
-        # Load vote rights table
-        self.vote_rights = pd.read_csv('vote_config.csv', sep=',')
+        # Edited commands are read whatever the post class, mediavida may
+        # mark edited posts with another class than the regular post ones
+        if self.day_commands.get(post.post_id, (post.author, ()))[1] == post.edit_commands:
+            metrics.REGISTRY.inc('post_edits_total', game=self.thread_id, kind='text')
+            self.log.debug(f'Post {post.post_id} by {post.author} was edited, its commands did not change')
+            return
 
-        # use lowercase player names as keys, player column as true names
-        self.vote_rights.index = self.vote_rights['player'].str.lower()
+        metrics.REGISTRY.inc('post_edits_total', game=self.thread_id, kind='commands')
 
-        # We'll use this table as the master table for real names
-        self.real_names = self.vote_rights['player'].to_dict()
-        self.real_names[self.game_master.lower()] = 'GM'
+        if self.edit_policy == 'ignore' or self.majority_reached:
+            self.log.info(f'Commands of post {post.post_id} by {post.author} were edited to {list(post.edit_commands)}. '
+                          f'The edit is ignored.')
 
-        self.vote_requests = pd.DataFrame({'player' : self.vote_rights['player'],
-                                          'max_vote_requests': self.vote_rights['allowed_vote_requests'],
-                                          'vote_requested':0})
+        elif self.edit_policy == 'report':
+            self.log.warning(f'Commands of post {post.post_id} by {post.author} were edited to {list(post.edit_commands)}. '
+                             f'The edit is ignored and reported in the next vote count.')
 
+            if post.post_id not in self.reported_edits:
+                self.reported_edits.append(post.post_id)
 
-        self.majority_reached         = False
+        else:
+            self.log.warning(f'Commands of post {post.post_id} by {post.author} were edited to {list(post.edit_commands)}. '
+                             f'Counting again from that post.')
 
-        # Temporal fix until proper votecount request queue is implemented
-        self.gm_vote_request          = False
+            self.day_commands[post.post_id] = (post.author, post.edit_commands)
 
-        print('Mafia MV Bot started!')
-        print('Game run by:', game_master)
-        print('Bot ID is', self.bot_ID)
+            if not post.edit_commands:
+                del self.day_commands[post.post_id]
 
-        logging.info(f'Bot started. Game run by {game_master}. Bot id is: {self.bot_ID}')
+            self.recount_day_commands()
 
-        self.run(loop_waittime_seconds)
-    
-    def run(self, update_tick:int):
+
+    def recount_day_commands(self):
         '''
-        Main bot loop. Called in class constructor. It iterates each N seconds,
-        as defined by the config file. For each iteration, it parses the game
-        thread if we are on day phase, then counts all the votes and decides
-        if a new vote count should be pushed.
+        Rebuilds the vote ledger of the current day from the commands kept in
+        memory, up to the counting cursor. Posts before an edit are applied
+        as they were, so only the votes from the edited post onwards change.
+        No page is downloaded again, and the votes already counted are not
+        logged nor counted in the metrics and thread activity again.
 
-        Parameters: 
-        update_tick (int): Seconds to pass between bot iterations.
+        Parameters: None
 
         Returns: None
         '''
 
-        while(True):
+        self.vote_ledger = vote_ledger.VoteLedger()
 
-            # Initialize empty vote table
-            self.vote_table = pd.DataFrame(columns=['player', 'voted_by', 'post_id'])
+        for post_id, (author, commands) in sorted(self.day_commands.items()):
+            self.apply_commands(author, commands, post_id, recount=True)
 
-            if self.is_day_phase(): # Daytime, count
 
-                print('We are on day time!')
+    def iter_new_posts(self, first_page:int, last_page:int):
+        '''
+        Streams the posts of a range of thread pages that are newer than the
+        counting cursor, in post order.
 
-                self.last_votecount_id = self.get_last_votecount()
+        Parameters:\n
+        first_page (int): First page of the range.
+        last_page (int): Last page of the range.
 
-                if not self.majority_reached:
+        Returns:
+        A generator of PostRecord.
+        '''
 
-                    self.last_thread_post  = self.get_last_post()
+        for page_number, page in self.iter_thread_pages(first_page, last_page):
 
-                    logging.info(f'Starting vote count. Last vote count: {self.last_votecount_id}. Last reply: {self.last_thread_post}')
+            self.log.info(f'Checking page: {page_number}')
 
-                    self._start_page = self.get_page_number_from_post(self.current_day_start_post)
-                    self._page_count = self.request_page_count()
+            for post in page.posts:
 
-                    logging.info(f'Detected day start at page: {self._start_page}')
-                    logging.info(f'Detected {self._page_count} pages')
+                if post.post_id > self.last_processed_post:
+                    yield post
 
-                    for self._cur_page in range(self._start_page, (self._page_count + 1)):
+                elif post.post_id in self.post_hashes:
+                    self.check_edit(post)
 
-                        logging.info(f'Checking page: {self._cur_page}')
+            # Only the page the next iteration resumes from is checked again
+            if page.posts:
+                self.post_hashes = {post_id: content_hash for post_id, content_hash in self.post_hashes.items()
+                                    if post_id >= page.posts[0].post_id}
 
-                        self.get_votes_from_page(page_to_scan=self._cur_page)
 
-                    logging.info('Finished counting.')
-                    print('Finished counting')
+    def iter_thread_pages(self, first_page:int, last_page:int):
+        '''
+        Streams a range of thread pages. Pages are downloaded concurrently in
+        batches of as many pages as fetch workers, or as the smallest batch
+        the parser process pool takes, whichever is larger. Pages already in
+        the iteration memo are reused, the rest are not added to it: each
+        batch of bodies and records is dropped once the caller moves past it.
 
-                    if self.update_thread_vote_count():
+        Parameters:\n
+        first_page (int): First page of the range.
+        last_page (int): Last page of the range.
 
-                        logging.info('Pushing a new votecount')
-                        self.push_vote_count()  
-                    
-                    else:
-                        logging.info('Recent votecount detected. ')
-                
-                else:
-                    logging.info('Majority already reached. Skipping...')
-                    
-            else:
-                logging.info('Night phase detected. Skipping...')
-                print('We are on night phase!')
-            
-            logging.info(f'Sleeping for {update_tick} seconds.')  
+        Returns:
+        A generator of (page number, ThreadPage) tuples.
+        '''
 
-            print(f'Sleeping for {update_tick} seconds.')
-            time.sleep(update_tick)
-    
+        self._page_count = self.get_thread_snapshot().page_count
+        batch_size       = max(1, self.http_client.fetch_workers, thread_parser.get_pool_batch_size())
 
+        for batch_start in range(first_page, last_page + 1, batch_size):
 
-    #TODO: This method can and should be refactored
-    def is_day_phase(self) -> bool:
+            batch  = range(batch_start, min(last_page, batch_start + batch_size - 1) + 1)
+            parsed = self.fetch_pages([(self.get_thread_page_url(page), self.is_page_immutable(page, self._page_count))
+                                       for page in batch if self.get_thread_page_url(page) not in self._tick_pages])
+
+            for page in batch:
+
+                url = self.get_thread_page_url(page)
+
+                yield page, self._tick_pages[url] if url in self._tick_pages else parsed.pop(url)
+
+
+    def process_post(self, post:thread_parser.PostRecord):
         '''
-        Parse the GM posts to figure out if the game is currently on game phase.
+        Evaluates the commands of a single post record. Votes are sent to
+        vote_player and GM vote count requests to vote_count_request.
 
-        Parameters: None
+        Parameters:\n
+        post (PostRecord): The post to evaluate.
 
-        Returns:
-        True/False (bool): Whether game is on day phase.
+        Returns: None
         '''
-        self._is_day_phase     = False
 
-        self._gm_posts         = self.game_thread + '?u=' + self.game_master
-        self._gm_posts         = requests.get(self._gm_posts).text
+        self.log_context['post_id'] = post.post_id
 
-        # Get total gm pages
-        self._gm_pages = self.get_page_count_from_page(self._gm_posts)
+        self.apply_commands(post.author, post.commands, post.post_id)
 
-        # We'll start looping from the last page to the previous one
-        for self._pagenum in range(self._gm_pages, 0, -1):
 
-            self._request      = f'{self.game_thread}?u={self.game_master}&pagina={self._pagenum}'
-            self._request      = requests.get(self._request).text
-            self._current_page = BeautifulSoup(self._request, 'html.parser')
+    def apply_commands(self, author:str, commands:tuple, post_id:int, recount:bool=False):
+        '''
+        Applies the commands of a post, see process_post.
 
-            #TODO: log these iterations?
-            self._posts        = self._current_page.find_all('div', attrs={'data-num':True,
-                                                                          'data-autor':True})
-          
-            for self._post in reversed(self._posts): # from more recent to older posts
+        Parameters:\n
+        author (str): The author of the post.
+        commands (tuple): Its commands, lowercase.
+        post_id (int): The post ID.
+        recount (bool): Whether the post is applied again by
+        recount_day_commands, see vote_player.
+
+        Returns: None
+        '''
 
-                self._headers = self._post.find_all('h2') # get all GM h2 headers
+        for command in commands:
 
-                for self._pday in self._headers:
-                    
-                    self._phase_end     = re.findall('^Final del día [0-9]*', self._pday.text)
-                    self._phase_start   = re.findall('^Día [0-9]*', self._pday.text)
+            victim = '' 
 
-                    if self._phase_end:
-                      return self._is_day_phase
-                      
-                    elif self._phase_start: 
+            if command == 'recuento':
 
-                        #TODO: We should start thinking about an standalone method here
-                        if self.current_day_start_post < int(self._post['data-num']):
-                            self.majority_reached = False
-                            self.vote_requests['vote_requested'] = 0
+                self.vote_count_request(player=author,
+                                        post_id=post_id)
 
-                        self.current_day_start_post = int(self._post['data-num'])
-                        self._is_day_phase = True
-                        self.player_list = self.get_player_list(self.current_day_start_post)
+            elif command == 'desvoto':
+                victim = 'desvoto'
+                
+            elif command.startswith('voto'):
+
+                if command.endswith('no linchamiento'):
+                    victim = 'no_lynch'
 
-        return self._is_day_phase
+                else:
+                    victim = command.split(' ')[-1]
 
+            if victim != '': 
+                self.vote_player(player=author,
+                                 victim=victim,
+                                 post_id=post_id,
+                                 recount=recount)
 
-    def update_thread_vote_count(self) -> bool:
+
+    def vote_count_request(self, player: str, post_id: int):
         '''
-        Decides if a new vote count should be posted based on:
-        
-        a) Pending GM requests.\n
-        b) How many messages were posted since the last vote count. This is used-defined.
+        This function is called after a possible vote count request by the game
+        GM is parsed. It first evaluates if the request originated from the GM
+        and then checks if the request post id is higher than the last automated
+        vote count ID. 
 
-        Parameters: None
+        If the request ID is higher than  the last vote count id, the flag
+        self.gm_vote_requests is set to True.
 
-        Returns:
-        True/False (bool): Whether to push a new vote count.
+        Parameters:\n
+        player (string): The author of the vote count request.
+        post_id (int): The post ID of the vote request.
+
+        Returns: None
         '''
+        if player == self.game_master.lower():
 
-        self._push = False
+           # GM request after our last vote count
+           if post_id > self.last_votecount_id:
+               self.gm_vote_request = True
 
-        self._posts_since_count = self.last_thread_post - self.last_votecount_id
 
-        if (self._posts_since_count >= self.post_push_interval) or self.gm_vote_request:
+    def request_page_count(self):
+        '''
+        Returns the total page length of the thread, see get_thread_snapshot.
+
+        Parameters: None.
 
-            self._push           = True
-            self.gm_vote_request = False
-            
-        return self._push
+        Returns: 
+        An int representing the total page length of the thread.
+        '''
 
+        return self.get_thread_snapshot().page_count
 
-    def get_last_votecount(self) -> int:
+
+    def get_thread_snapshot(self) -> thread_parser.ThreadSnapshot:
         '''
-        Parses the bot messages in the game thread to get the post id of the 
-        last automated vote count pushed.
-    
-        Parameters: None
+        Reads the page count and the last post id of the thread once per
+        iteration. Instead of thread page 1, the last page known from the
+        previous iteration is requested: it carries the page panel and, while
+        no new page was started, the last post too. Otherwise the new last
+        page is requested as well. Both pages stay in the iteration memo, so
+        the vote count reuses them.
+
+        Parameters: None.
 
         Returns:
-        An int representing the post id of the last automated vote count.
+        A ThreadSnapshot.
         '''
 
-        self._bot_posts         = self.game_thread + '?u=' + self.bot_ID
-        self._bot_posts         = requests.get(self._bot_posts).text
-
-        self._last_votecount_id = 1 
-        
-        # Get total gm pages
-        self._bot_pages = self.get_page_count_from_page(self._bot_posts)
+        if self.thread_snapshot is not None:
+            return self.thread_snapshot
 
-         # We'll start looping from the last page to the previous one
-        for self._pagenum in range(self._bot_pages, 0, -1):
+        try:
+            self._probe = self.get_page(self.get_thread_page_url(self.last_known_page))
 
-            self._request      = f'{self.game_thread}?u={self.bot_ID}&pagina={self._pagenum}'
-            self._request      = requests.get(self._request).text
-            self._current_page = BeautifulSoup(self._request, 'html.parser')
+        # The page is gone, posts were deleted
+        except requests.HTTPError:
+            self._probe = None
 
-            #TODO: log these iterations?
-            self._posts        = self._current_page.find_all('div', attrs={'data-num':True,
-                                                                          'data-autor':True})
-          
-            for self._post in reversed(self._posts): # from more recent to older posts
+        if self._probe is None or (not self._probe.posts and self.last_known_page > 1):
+            self.last_known_page = 1
+            self._probe = self.get_page(self.get_thread_page_url(1))
 
-                self._headers = self._post.find_all('h2') #get all GM h2 headers
+        self._probe_pages = self.get_probe_page_count()
 
-                for self._pcount in self._headers:
-                    
-                    self._last_count_id = re.findall('^Recuento de votos$', self._pcount.text)
-                    self._last_count_was_lynch = re.findall('^Recuento de votos final$', self._pcount.text)
+        if self._probe_pages != self.last_known_page:
+            self._probe       = self.get_page(self.get_thread_page_url(self._probe_pages))
+            self._probe_pages = self.get_probe_page_count()
 
-                    # Hacky way to cover oddball case of the bot 
-                    # shutting down and a player editing after EoD
-                    if self._last_count_was_lynch or self._last_count_id:
+        self.last_known_page = self._probe_pages
+        self.thread_snapshot = thread_parser.ThreadSnapshot(page_count=self.last_known_page,
+                                                            last_post_id=self._probe.posts[-1].post_id)
 
-                        if self._last_count_was_lynch and self.current_day_start_post < int(self._post['data-num']):
-                            self.majority_reached = True
+        return self.thread_snapshot
 
-                        self._last_votecount_id = int(self._post['data-num'])
-                        return self._last_votecount_id
-    
-        
-        return self._last_votecount_id
 
-    
-    def get_last_post(self) -> int:
+    def get_probe_page_count(self) -> int:
+        '''
+        Page count read from the page probed by get_thread_snapshot. The
+        thread has at least as many pages as the page its last post is on,
+        whatever the page panel says.
         '''
-        Parses the game thread messages to get the post id of the 
-        last posted message.
-    
-        Parameters: None
 
-        Returns:
-        An int representing the post id of the last posted message.
+        if not self._probe.posts:
+            return self._probe.page_count
+
+        return max(self._probe.page_count, self.get_page_number_from_post(self._probe.posts[-1].post_id))
+
+
+    def get_page(self, url:str, immutable:bool=False) -> thread_parser.ThreadPage:
         '''
-        self._last_post_id = 1
+        Downloads and parses a mediavida page into post records. Pages are
+        memoized for the current iteration, so every consumer (phase detection,
+        vote count detection and vote counting) shares a single download and
+        parse of each page per tick.
 
-        self._last_page = self.request_page_count()
-        self._request   = f'{self.game_thread}/{self._last_page}'
-        self._request   =  requests.get(self._request).text
+        Immutable pages are served from the on-disk page cache and only
+        revalidated every self.page_revalidate_seconds. The rest are always
+        revalidated with a conditional request.
+
+        Parameters: 
+        url (str): The page to retrieve.
+        immutable (bool): Whether the page is full and not expected to change.
 
-        self._page      = BeautifulSoup(self._request, 'html.parser')
+        Returns: 
+        A ThreadPage with the post records and page count of the page.
+        '''
 
-        self._all_posts = self._page.find_all('div', attrs={'data-num':True,
-                                                            'data-autor':True})
+        if url not in self._tick_pages:
+            self.prefetch_pages([(url, immutable)])
 
-        return int(self._all_posts[-1]['data-num'])
+        return self._tick_pages[url]
 
 
-    def get_votes_from_page(self, page_to_scan:int):
+    def prefetch_pages(self, pages:list):
         '''
-        Parses a defined page of the game thread and retrieves all h4 
-        HTML elements, which may be commands or votes. Each h4 element is evaluated
-        to decide if a vote or a command was casted. 
+        Downloads and parses several pages concurrently and stores them in
+        the current iteration memo. Pages are only fetched here, callers still
+        walk them in order through get_page so vote semantics do not depend
+        on download order.
 
-        For a vote, the vote_player function will be called. For a command,
-        the command routine is called instead.
-    
-        Parameters:\n
-        page_to_scan (int): A game thread page to parse.
+        Parameters: 
+        pages (list): A list of (url, immutable) tuples, see get_page.
 
         Returns: None
         '''
 
-        self._parsed_url = f'{self.game_thread}/{page_to_scan}'
-        self._request    = requests.get(self._parsed_url).text
-        
-        self._parser = BeautifulSoup(self._request, 'html.parser')
+        self._tick_pages.update(self.fetch_pages([(url, immutable) for url, immutable in pages
+                                                  if url not in self._tick_pages]))
 
-        # MV has unqiue div elements for odd and even posts, 
-        # and another one for the very first post of the page.
-        # I'm ignoring edit div elements because players should not edit while
-        # playing.
 
-        self._posts = self._parser.findAll('div', class_ = ['cf post',
-                                                'cf post z',
-                                                'cf post first'
-                                                ])
+    def fetch_pages(self, pages:list) -> dict:
+        '''
+        Downloads and parses several pages concurrently. Parsing goes to the
+        parser process pool when it is enabled (see
+        thread_parser.set_parse_workers).
 
-        for self._post in self._posts:
+        Parameters: 
+        pages (list): A list of (url, immutable) tuples, see get_page.
 
-            self._author  = self._post['data-autor'].lower()
-            self._post_id = int(self._post['data-num'])
-            self._post_content = self._post.find('div', class_ = 'post-contents')
-            self._post_commands = self._post_content.findAll('h4')
+        Returns:
+        A url -> ThreadPage dict.
+        '''
 
-            if self._post_id > self.current_day_start_post:
+        if not pages:
+            return {}
 
-                for self._command in self._post_commands:
+        bodies = self.http_client.get_many([(url, self.page_revalidate_seconds if immutable else 0)
+                                            for url, immutable in pages])
 
-                    self._victim = '' 
-                    self._command = self._command.text.lower()
-                    
-                    if self._command == 'recuento':
+        # Pages parsed in the bot process are timed one by one, pages parsed
+        # in parallel by the pool only have the mean of their batch
+        if thread_parser.uses_parse_pool(len(bodies)):
 
-                        self.vote_count_request(player=self._author,
-                                                post_id=self._post_id)
+            parse_started = time.perf_counter()
 
-                    elif self._command == 'desvoto':
-                        self._victim = 'desvoto'
-                        
-                    elif self._command.startswith('voto'):
+            parsed = thread_parser.parse_pages(bodies)
 
-                        if self._command.endswith('no linchamiento'):
-                            self._victim = 'no_lynch'
+            parse_seconds = time.perf_counter() - parse_started
 
-                        else:
-                            self._victim = self._command.split(' ')[-1]
+            for _ in pages:
+                metrics.REGISTRY.observe('page_parse_seconds', parse_seconds / len(pages))
 
-                       
-                    
-                    if self._victim != '': 
-                        self.vote_player(player=self._author,
-                                         victim=self._victim,
-                                         post_id=self._post_id)
+            self.tick_timings['parse_seconds'] += parse_seconds
 
+        else:
 
+            parsed = []
 
-    def vote_count_request(self, player: str, post_id: int):
-        '''
-        This function is called after a possible vote count request by the game
-        GM is parsed. It first evaluates if the request originated from the GM
-        and then checks if the request post id is higher than the last automated
-        vote count ID. 
+            for position in range(len(bodies)):
 
-        If the request ID is higher than  the last vote count id, the flag
-        self.gm_vote_requests is set to True.
+                parse_started = time.perf_counter()
 
-        Parameters:\n
-        player (string): The author of the vote count request.
-        post_id (int): The post ID of the vote request.
+                parsed.append(thread_parser.parse_page(bodies[position]))
+                bodies[position] = None
+
+                parse_seconds = time.perf_counter() - parse_started
+
+                metrics.REGISTRY.observe('page_parse_seconds', parse_seconds)
+                self.tick_timings['parse_seconds'] += parse_seconds
+
+        self.tick_timings['pages_parsed'] += len(pages)
+
+        return {url: page for (url, _), page in zip(pages, parsed)}
+
+
+    def prefetch_user_pages(self, user_id:str, page:int, page_count:int):
+        '''
+        Used when walking the pages of a user filtered thread from the last
+        one backwards. If the given page is not downloaded yet, it is fetched
+        along with the previous ones in a single concurrent batch.
+
+        Parameters: 
+        user_id (str): The user the thread is filtered by.
+        page (int): The page about to be read.
+        page_count (int): The page count of the filtered thread.
 
         Returns: None
         '''
-        if player == self.game_master.lower():
 
-           # GM request after our last vote count
-           if post_id > self.last_votecount_id:
-               self.gm_vote_request = True
+        if self.get_user_posts_url(user_id, page) in self._tick_pages:
+            return
 
+        batch = range(page, max(0, page - self.http_client.fetch_workers), -1)
 
-    def request_page_count(self):
+        self.prefetch_pages([(self.get_user_posts_url(user_id, batch_page),
+                              self.is_page_immutable(batch_page, page_count)) for batch_page in batch])
+
+
+    def is_page_immutable(self, page:int, page_count:int) -> bool:
         '''
-        Performs an HTML request of the game thread and parses the resulting
-        HTML code to get the total page length of the thread.
+        A page is considered immutable once it is full, that is, when it is
+        not the last one.
 
-        Parameters: None.
+        Parameters:
+        page (int): The page number.
+        page_count (int): The current page count of the thread.
 
-        Returns: 
-        An int representing the total page length of the thread.
+        Returns:
+        True/False (bool): Whether the page can be served from cache.
         '''
-        
-        self._request = requests.get(self.game_thread).text
-        self._page_count = self.get_page_count_from_page(self._request)
 
-        return self._page_count
+        return page < page_count
 
 
-    def get_page_count_from_page(self, request_text):
+    def get_thread_page_url(self, page:int) -> str:
+        '''
+        Builds the URL of a game thread page.
         '''
-        Parses an used defined HTML code from mediavida.com to extract the page
-        count of a given thread. To do so it uses BeautifulSoup as a parser engine.
 
-        Parameters: 
-        request_text: A string of HTML text from the requests.get library.
+        if page == 1:
+            return self.game_thread
 
-        Returns: 
-        An int representing the total page length of the thread.
+        return f'{self.game_thread}/{page}'
+
+
+    def get_user_posts_url(self, user_id:str, page:int) -> str:
+        '''
+        Builds the URL of a page of the game thread filtered by a single user.
         '''
 
-        # Let's try to parse the page count from the bottom  page panel
-        self._page_count = 1
-        try:
-            self._panel_layout = BeautifulSoup(request_text, 'html.parser') 
-            self._panel_layout = self._panel_layout.find('div', id = 'bottompanel')
+        if page == 1:
+            return f'{self.game_thread}?u={user_id}'
 
-            self._result = self._panel_layout.find_all('a')[-2].contents[0]
-            self._page_count = int(self._result)
-        except:
-            self._page_count = 1
-        
-        return self._page_count
+        return f'{self.game_thread}?u={user_id}&pagina={page}'
 
 
     def get_page_number_from_post(self, post_id:int):
@@ -448,28 +1514,17 @@ class MafiaBot:
         A list (collection) of (string) players.
         '''
         self._start_day_page = self.get_page_number_from_post(start_day_post_id)
-
-        self._request_url = f'{self.game_thread}/{self._start_day_page}'
-        self._request     = requests.get(self._request_url).text
-
-        self._response  = BeautifulSoup(self._request, 'html.parser')
-        self._all_posts = self._response.find_all('div', attrs={'data-num':True,
-                                                                'data-autor':True})
+        self._all_posts      = self.get_page(self.get_thread_page_url(self._start_day_page),
+                                             immutable=self.is_page_immutable(self._start_day_page,
+                                                                              self.get_thread_snapshot().page_count)).posts
         
-        self._player_list = []
-
         for self._post in self._all_posts:
 
             # We found the post of interest
-            if int(self._post['data-num']) == start_day_post_id: 
-
-                # Get the first list. It should be the player lists according to the template
-                self._players = self._post.find('ol').find_all('a')
+            if self._post.post_id == start_day_post_id: 
+                return list(self._post.player_list)
 
-                for self._player in self._players:
-                    self._player_list.append(self._player.contents[0].lower())
-
-                return self._player_list
+        return []
 
 
     def is_valid_vote(self, player:str, victim:str) -> bool:
@@ -497,9 +1552,9 @@ class MafiaBot:
                     self._player_max_votes = 999
 
                 else:
-                    self._player_max_votes = self.vote_rights.loc[player, 'allowed_votes']
+                    self._player_max_votes = self.vote_rights.get(player, 'allowed_votes')
 
-                self._player_current_votes = len(self.vote_table[self.vote_table['voted_by'] == player])
+                self._player_current_votes = self.vote_ledger.get_votes_cast(player)
             
                 if victim == 'desvoto' and self._player_current_votes > 0:
                     self._is_valid_vote = True
@@ -509,17 +1564,17 @@ class MafiaBot:
             
                 elif victim in self.player_list:
 
-                    if victim in self.vote_rights.index:
+                    if victim in self.vote_rights:
 
-                        if self.vote_rights.loc[victim, 'can_be_voted'] == 1:
+                        if self.vote_rights.get(victim, 'can_be_voted') == 1:
 
                             if self._player_current_votes < self._player_max_votes:
 
                                 self._is_valid_vote = True
                     else:
-                        logging.warning(f'Player {victim} is not on the vote rights table.')
+                        self.log.warning(f'Player {victim} is not on the vote rights table.')
         else:
-            logging.info(f'Rejecting vote from {player} to {victim} because majority was already reached')
+            self.log.info(f'Rejecting vote from {player} to {victim} because majority was already reached')
         
         return self._is_valid_vote
 
@@ -539,8 +1594,8 @@ class MafiaBot:
         self._lynched = False
 
         # Count this player votes
-        self._lynch_votes = len(self.vote_table[self.vote_table['player'] == victim])
-        self._player_majority = self.get_vote_majority() + self.vote_rights.loc[victim, 'mod_to_lynch']
+        self._lynch_votes = self.vote_ledger.get_vote_count(victim)
+        self._player_majority = self.get_vote_majority() + self.vote_rights.get(victim, 'mod_to_lynch')
 
         if self._lynch_votes >= self._player_majority:
             self._lynched = True
@@ -548,14 +1603,17 @@ class MafiaBot:
         return self._lynched
 
     
-    def vote_player(self, player:str, victim:str, post_id:int):
+    def vote_player(self, player:str, victim:str, post_id:int, recount:bool=False):
         '''
-        This function process votes and keeps track of the vote table. Votes are added or removed based on the victim. 
+        This function process votes and keeps track of the vote ledger. Votes are added or removed based on the victim. 
 
         Parameters:\n
         player (str): The player who casts the vote.\n
         victim (str): The player who receives the vote. Can be set to "desvoto" to remove a previously casted voted by player.\n
         post_id  (int): The post ID where the vote was casted.\n
+        recount (bool): Whether the vote was already counted once. Recounted
+        votes only update the vote ledger, they are not logged nor counted
+        in the metrics and thread activity again.\n
         Returns:\n 
         True if the player should be lynched.  False otherwise.
         '''
@@ -563,33 +1621,40 @@ class MafiaBot:
         if self.is_valid_vote(player, victim):
 
             if victim == 'desvoto':
-                self._old_vote = self.vote_table[self.vote_table['voted_by'] == player].index[0]
-                self.vote_table.drop(self._old_vote, axis=0, inplace=True)
+                self.vote_ledger.unvote(player)
+
+                if not recount:
+                    self.activity['new_votes'] = self.activity.get('new_votes', 0) + 1
 
-                logging.info(f'Player {player} unvoted at {post_id}')
+                    metrics.REGISTRY.inc('votes_processed_total', game=self.thread_id, result='unvote')
+
+                    self.log.info(f'Player {player} unvoted at {post_id}')
             
             else:
                
-                self.vote_table  = self.vote_table.append({'player': victim,
-                                                           'voted_by': player,
-                                                           'post_id': post_id},
-                                                           ignore_index=True)
+                self.vote_ledger.cast(voter=player, victim=victim, post_id=post_id)
+
+                if not recount:
+                    self.activity['new_votes'] = self.activity.get('new_votes', 0) + 1
+
+                    metrics.REGISTRY.inc('votes_processed_total', game=self.thread_id, result='vote')
                 
-                logging.info(f'{player} voted {victim} at {post_id}')
+                    self.log.info(f'{player} voted {victim} at {post_id}')
 
                 #Check if we have reached majority
                 if self.is_lynched(victim):
                     self.lynch_player(victim, post_id)   
 
-        else:
-            logging.warning(f'Invalid vote by {player} at {post_id}. They voted {victim}')
+        elif not recount:
+            metrics.REGISTRY.inc('votes_processed_total', game=self.thread_id, result='invalid')
+            self.log.warning(f'Invalid vote by {player} at {post_id}. They voted {victim}')
 
 
     def lynch_player(self, victim:str, post_id:int):
         '''
-        When this function is called, a new User object is built to push a vote
-        count in which the lynch is  announced. It also sets self.majority_reached
-        to True, indicating to the bot that no more votes are allowed until a new day starts. 
+        When this function is called, a vote count in which the lynch is
+        announced is pushed. It also sets self.majority_reached to True,
+        indicating to the bot that no more votes are allowed until a new day starts. 
 
         Parameters:\n
         victim (str): The player to lynch.\n
@@ -598,41 +1663,149 @@ class MafiaBot:
         '''
 
         self.majority_reached        = True
+        self.pending_lynch           = {'victim': victim, 'post_id': post_id}
 
+        self.queue_lynch()
 
-        self._user = user.User(thread_id=self.thread_id, 
-                               thread_url= self.game_thread,
-                               bot_id= self.bot_ID,
-                               bot_password=self.bot_password,
-                               game_master= self.game_master)
-        
-        self._user.push_lynch(last_votecount=self.translate_votecount_names(),
-                              victim=self.real_names[victim],
-                              post_id=post_id)
+        # Until the real post id is known, the lynch counts from the vote
+        # that triggered it
+        self.last_votecount_id       = post_id
+        self.last_votecount_final    = True
+
+
+    def queue_lynch(self):
+        '''
+        Queues the announcement of self.pending_lynch with the current vote table.
+
+        Parameters: None
+        Returns: None
+        '''
+
+        self.post_queue.submit(thread_id=self.thread_id,
+                               account=self.bot_ID,
+                               kind='lynch',
+                               phase=self.current_day_start_post,
+                               send=functools.partial(self.send_lynch,
+                                                      last_votecount=self.translate_votecount_names(),
+                                                      victim=self.real_names[self.pending_lynch['victim']],
+                                                      post_id=self.pending_lynch['post_id']),
+                               on_done=functools.partial(self.on_posted, final=True,
+                                                         started=getattr(self, '_tick_started', time.perf_counter())))
 
     
     def push_vote_count(self):
         '''
-        When this function is called, a new User object is built to push a vote
-        count using the current vote table. The object is deleted when the function
-        ends.
+        When this function is called, a vote count is queued using the current
+        vote table. A vote count still waiting in the queue is replaced by it.
 
         Parameters: None
         Returns: None
         '''
-        
-        self.User = user.User(thread_id= self.thread_id,
-                              thread_url=self.game_thread,
-                              bot_id=self.bot_ID,
-                              bot_password=self.bot_password,
-                              game_master=self.game_master)
-                    
-        self.User.push_votecount(vote_count=self.translate_votecount_names(),
-                                 alive_players=len(self.player_list),
-                                 vote_majority=self.get_vote_majority(),
-                                 post_id=self.last_thread_post)
 
-        del self.User
+        self.last_pushed_fingerprint = self.get_votecount_fingerprint()
+
+        self.post_queue.submit(thread_id=self.thread_id,
+                               account=self.bot_ID,
+                               kind='votecount',
+                               phase=self.current_day_start_post,
+                               send=functools.partial(self.send_vote_count,
+                                                      vote_count=self.translate_votecount_names(),
+                                                      alive_players=len(self.player_list),
+                                                      vote_majority=self.get_vote_majority(),
+                                                      post_id=self.last_thread_post,
+                                                      fingerprint=self.last_pushed_fingerprint,
+                                                      edited_posts=list(self.reported_edits)),
+                               on_done=functools.partial(self.on_posted, final=False,
+                                                         started=self._tick_started))
+
+        # Until the real post id is known, the count covers up to the last post
+        self.last_votecount_id    = self.last_thread_post
+        self.last_votecount_final = False
+
+        self.reported_edits       = []
+
+
+    def send_vote_count(self, vote_count:pd.DataFrame, alive_players:int, vote_majority:int, post_id:int,
+                        fingerprint:str=None, edited_posts:list=None) -> str:
+        '''
+        Posts a vote count. Runs on the outbound queue worker.
+        '''
+
+        return self.get_poster().push_votecount(vote_count=vote_count,
+                                                alive_players=alive_players,
+                                                vote_majority=vote_majority,
+                                                post_id=post_id,
+                                                fingerprint=fingerprint,
+                                                edited_posts=edited_posts)
+
+
+    def send_lynch(self, last_votecount:pd.DataFrame, victim:str, post_id:int) -> str:
+        '''
+        Posts a lynch announcement. Runs on the outbound queue worker.
+        '''
+
+        return self.get_poster().push_lynch(last_votecount=last_votecount,
+                                            victim=victim,
+                                            post_id=post_id)
+
+
+    def on_posted(self, post_url:str, final:bool, started:float):
+        '''
+        Outbound queue callback. Runs on the queue worker, so the result is
+        only stored here and applied by apply_posted on the bot thread.
+        '''
+
+        if final and post_url is not None:
+            # From the start of the iteration that found the majority to the lynch post
+            metrics.REGISTRY.observe('lynch_push_seconds', time.perf_counter() - started, game=self.thread_id)
+
+        self._posted.append((post_url, final))
+
+
+    def apply_posted(self):
+        '''
+        Records the vote counts the outbound queue posted since the last
+        iteration.
+
+        Parameters: None
+        Returns: None
+        '''
+
+        while self._posted:
+
+            post_url, final = self._posted.popleft()
+
+            if final:
+                self.pending_lynch = None
+
+            # The count was never posted, do not hold back the next one
+            elif post_url is None:
+                self.last_pushed_fingerprint = None
+
+            self.record_votecount(post_url, final=final)
+
+
+    def get_poster(self) -> user.User:
+        '''
+        Returns the posting client of the bot. It is built, and logged in, on
+        first use and then kept for the whole game so the session cookies are
+        reused by every post.
+
+        Parameters: None
+        Returns:
+        A logged in user.User object.
+        '''
+
+        if self.poster is None:
+            self.poster = user.User(thread_id=self.thread_id,
+                                    thread_url=self.game_thread,
+                                    bot_id=self.bot_ID,
+                                    bot_password=self.bot_password,
+                                    game_master=self.game_master,
+                                    session=self.forum_session,
+                                    rights=self.vote_rights)
+
+        return self.poster
 
 
     def translate_votecount_names(self):
@@ -640,10 +1813,11 @@ class MafiaBot:
         This function translates lowercased player names to their actual mediavida
         names for a fancier vote count post. To do so, it relies on the vote_rights
         table, which features a player column. A dictionary is built in which
-        the table index is the lowercased player name and the dict. values are taken
+        the keys are the lowercased player names and the values are taken
         from the player column. 
 
-        The vote table names are then mapped using this dictionary.
+        The vote ledger is exported to a vote table and its names are then
+        mapped using this dictionary.
 
         Parameters: None \n
         Returns: 
@@ -651,13 +1825,37 @@ class MafiaBot:
         their real mediavida names.
         '''
 
-        self._translat_votetable = self.vote_table
+        self._translat_votetable = self.vote_ledger.to_frame()
 
         self._translat_votetable['player']   = self._translat_votetable['player'].map(self.real_names)
         self._translat_votetable['voted_by'] = self._translat_votetable['voted_by'].map(self.real_names)
 
         return self._translat_votetable
 
+    def get_votes_to_majority(self):
+        '''
+        Calculates how many more votes the most voted player needs to be
+        lynched, taking each player lynch modifier into account.
+
+        Parameters: None \n
+        Returns: \n
+        The fewest votes missing for any voted player to be lynched (int), or
+        None if nobody has been voted.
+        '''
+
+        self._votes_to_majority = None
+
+        for self._victim in self.vote_ledger.voters_by_victim:
+
+            self._missing = (self.get_vote_majority() + self.vote_rights.get(self._victim, 'mod_to_lynch')
+                             - self.vote_ledger.get_vote_count(self._victim))
+
+            if self._votes_to_majority is None or self._missing < self._votes_to_majority:
+                self._votes_to_majority = int(self._missing)
+
+        return self._votes_to_majority
+
+
     def get_vote_majority(self) -> int:
         '''
         Calculates the amount of votes necessary to reach an absolute majority
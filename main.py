@@ -1,27 +1,47 @@
-import logging
-
 import os.path
 import pandas as pd
 
-import mafia_bot
+import bot_logging
+import http_client
+import metrics
+import orchestrator
+import page_cache
+import post_queue
+import state_store
+import thread_parser
 import user
 
+logger = bot_logging.get_logger('main')
+
+
+def get_optional_config(config, key:str, default):
+    '''
+    Reads an optional key from the config table, falling back to a default
+    value when the key is missing or empty.
+    '''
+
+    if config is not None and key in config.index and not pd.isna(config.loc[key, 'value']):
+        return type(default)(config.loc[key, 'value'])
+
+    return default
+
+
 def main():
 
     ### SETUP UP PROGRAM LEVEL LOGGER ###
 
-    # create logger
-    logger = logging.getLogger("mafia_bot")
-    logger.setLevel(logging.DEBUG)
-
-    #TODO: make this configurable
-    logging.basicConfig(filename='mafia.log',
-                        level=logging.DEBUG,
-                        format='%(asctime)s %(message)s')
+    # Logging is set up before anything else, from config.csv if it can be
+    # read. Third party loggers (requests, urllib3) only log warnings.
+    try:
+        config = pd.read_csv('config.csv', sep=',', index_col=0)
+    except:
+        config = None
 
-    # Silence requests logger #
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    log_listener = bot_logging.setup_logging(path=get_optional_config(config, 'log_file', 'mafia.log'),
+                                             levels=get_optional_config(config, 'log_levels', 'DEBUG'),
+                                             max_bytes=get_optional_config(config, 'log_max_bytes', 10 * 1024 * 1024),
+                                             backup_count=get_optional_config(config, 'log_backup_count', 5),
+                                             rotate_when=get_optional_config(config, 'log_rotate_when', ''))
 
     # Load confic  dict.
     bot_config = {'game_thread': '',
@@ -31,7 +51,9 @@ def main():
 
     ## Attempt to load config file ##
     try:
-        config = pd.read_csv('config.csv', sep=',', index_col=0)
+        if config is None:
+            raise FileNotFoundError('config.csv')
+
         bot_config['game_thread'] = config.loc['game_thread', 'value']
         bot_config['gm']          = config.loc['GM', 'value']
         bot_config['mv_id']       = config.loc['mediavida_user', 'value']
@@ -39,23 +61,104 @@ def main():
         bot_config['update_time_seconds'] = config.loc['update_time_seconds', 'value']
         bot_config['post_push_interval']  = config.loc['push_vote_count_interval', 'value']
 
+        bot_config['http_timeout_seconds'] = get_optional_config(config, 'http_timeout_seconds', 20.0)
+        bot_config['http_max_retries']     = get_optional_config(config, 'http_max_retries', 3)
+        bot_config['page_cache_dir']       = get_optional_config(config, 'page_cache_dir', 'page_cache')
+        bot_config['page_revalidate_seconds'] = get_optional_config(config, 'page_revalidate_seconds', 3600)
+        bot_config['fetch_workers']        = get_optional_config(config, 'fetch_workers', 4)
+        bot_config['state_db']             = get_optional_config(config, 'state_db', 'mafia_bot.db')
+        bot_config['cookie_dir']           = get_optional_config(config, 'cookie_dir', '')
+        bot_config['games_file']           = get_optional_config(config, 'games_file', '')
+        bot_config['min_update_time_seconds'] = get_optional_config(config, 'min_update_time_seconds', 0)
+        bot_config['max_update_time_seconds'] = get_optional_config(config, 'max_update_time_seconds', 0)
+        bot_config['watch_interval_seconds'] = get_optional_config(config, 'watch_interval_seconds', 0)
+        bot_config['edit_policy']          = get_optional_config(config, 'edit_policy', 'ignore')
+        bot_config['post_spacing_seconds'] = get_optional_config(config, 'post_spacing_seconds', 30.0)
+        bot_config['post_max_retries']     = get_optional_config(config, 'post_max_retries', 3)
+        bot_config['html_parser']          = get_optional_config(config, 'html_parser', 'auto')
+        bot_config['parse_workers']        = get_optional_config(config, 'parse_workers', 0)
+        bot_config['parse_pool_min_pages'] = get_optional_config(config, 'parse_pool_min_pages', 4)
+        bot_config['metrics_port']         = get_optional_config(config, 'metrics_port', 0)
+        bot_config['metrics_json_file']    = get_optional_config(config, 'metrics_json_file', '')
+        bot_config['max_connections_per_host'] = get_optional_config(config, 'max_connections_per_host', 4)
+
         print('Configuration... LOADED')
-        logging.info('Configuration loaded')
+        logger.info('Configuration loaded')
     
     except:
-        logging.critical('Failed to load config.csv')
+        logger.critical('Failed to load config.csv')
+        log_listener.stop()
         raise
     
 
 
-    MafiaBot = mafia_bot.MafiaBot(game_url=bot_config['game_thread'],
-                                  game_master=bot_config['gm'],
-                                  bot_userID=bot_config['mv_id'],
-                                  bot_password=bot_config['mv_password'],
-                                  loop_waittime_seconds=int(bot_config['update_time_seconds']),
-                                  post_push_interval = int(bot_config['post_push_interval'])
-                                 )
-    
+    thread_parser.set_backend(bot_config['html_parser'])
+    logger.info(f'Parsing pages with {thread_parser.backend}')
+
+    # Parser processes for cold counts over many pages, disabled with 0
+    thread_parser.set_parse_workers(bot_config['parse_workers'], bot_config['parse_pool_min_pages'])
+
+    cache  = page_cache.PageCache(cache_dir=bot_config['page_cache_dir'])
+    client = http_client.HttpClient(read_timeout=bot_config['http_timeout_seconds'],
+                                    max_retries=bot_config['http_max_retries'],
+                                    page_cache=cache,
+                                    fetch_workers=bot_config['fetch_workers'],
+                                    max_per_host=bot_config['max_connections_per_host'])
+
+    # Prometheus style metrics on localhost, disabled with port 0
+    if bot_config['metrics_port']:
+        metrics.MetricsServer(metrics.REGISTRY, port=bot_config['metrics_port']).start()
+
+    games = orchestrator.Orchestrator(client=client,
+                                      store=state_store.StateStore(bot_config['state_db']),
+                                      cookie_dir=bot_config['cookie_dir'] or None,
+                                      metrics_json_file=bot_config['metrics_json_file'] or None,
+                                      outbound=post_queue.PostQueue(min_spacing_seconds=bot_config['post_spacing_seconds'],
+                                                                    max_retries=bot_config['post_max_retries']))
+
+    # Several games can be listed in a games file, otherwise run the game in config.csv
+    if bot_config['games_file']:
+
+        try:
+            games_config = pd.read_csv(bot_config['games_file'], sep=',')
+        except:
+            logger.critical(f"Failed to load {bot_config['games_file']}")
+            raise
+
+        for _, game in games_config.iterrows():
+            games.add_game(game_url=game['game_thread'],
+                           game_master=game['gm'],
+                           bot_userID=game['mediavida_user'],
+                           bot_password=game['mediavida_password'],
+                           update_time_seconds=int(game['update_time_seconds']),
+                           post_push_interval=int(game['push_vote_count_interval']),
+                           vote_config_path=game['vote_config'],
+                           page_revalidate_seconds=bot_config['page_revalidate_seconds'],
+                           min_update_time_seconds=bot_config['min_update_time_seconds'],
+                           max_update_time_seconds=bot_config['max_update_time_seconds'],
+                           watch_interval_seconds=bot_config['watch_interval_seconds'],
+                           edit_policy=bot_config['edit_policy'])
+
+    else:
+        games.add_game(game_url=bot_config['game_thread'],
+                       game_master=bot_config['gm'],
+                       bot_userID=bot_config['mv_id'],
+                       bot_password=bot_config['mv_password'],
+                       update_time_seconds=int(bot_config['update_time_seconds']),
+                       post_push_interval = int(bot_config['post_push_interval']),
+                       page_revalidate_seconds=bot_config['page_revalidate_seconds'],
+                       min_update_time_seconds=bot_config['min_update_time_seconds'],
+                       max_update_time_seconds=bot_config['max_update_time_seconds'],
+                       watch_interval_seconds=bot_config['watch_interval_seconds'],
+                       edit_policy=bot_config['edit_policy'])
+
+    try:
+        games.run()
+
+    # Stop the parser processes and flush the pending log records before exiting
+    finally:
+        thread_parser.shutdown_parse_pool()
+        log_listener.stop()
 
 
  
@@ -0,0 +1,229 @@
+import collections
+import contextlib
+import http.server
+import json
+import os
+import tempfile
+import threading
+import time
+
+import bot_logging
+
+logger = bot_logging.get_logger('metrics')
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'mafia_bot_'
+
+
+class Metrics:
+    '''
+    Thread safe registry of counters, gauges and histograms, plus a rolling
+    list of per tick summaries. It can be exposed as Prometheus text through
+    MetricsServer and dumped to a JSON file.
+    '''
+
+    def __init__(self, recent_ticks:int=200):
+
+        self._lock      = threading.Lock()
+
+        # (name, labels) -> value. Labels are a sorted tuple of (key, value) pairs
+        self.counters   = {}
+        self.gauges     = {}
+
+        # (name, labels) -> {'buckets': [...], 'sum': float, 'count': int}
+        self.histograms = {}
+
+        self.ticks      = collections.deque(maxlen=recent_ticks)
+
+
+    def inc(self, name:str, value:float=1, **labels):
+        '''
+        Increments a counter.
+        '''
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def set(self, name:str, value:float, **labels):
+        '''
+        Sets a gauge.
+        '''
+
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+    def observe(self, name:str, value:float, **labels):
+        '''
+        Adds an observation to a histogram.
+        '''
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+            histogram = self.histograms[key]
+            histogram['sum']   += value
+            histogram['count'] += 1
+
+            for position, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][position] += 1
+
+
+    @contextlib.contextmanager
+    def timer(self, name:str, **labels):
+        '''
+        Context manager observing the time spent in its block.
+        '''
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def record_tick(self, summary:dict):
+        '''
+        Stores the summary of a bot tick in the rolling tick list.
+        '''
+
+        with self._lock:
+            self.ticks.append(dict(summary, time=time.time()))
+
+
+    def render_prometheus(self) -> str:
+        '''
+        Renders every metric in the Prometheus text exposition format.
+        '''
+
+        lines = []
+
+        with self._lock:
+
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {PREFIX}{name} {metric_type}')
+                    for (value_name, labels), value in values.items():
+                        if value_name == name:
+                            lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+
+            for name in sorted({name for name, _ in self.histograms}):
+
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+
+                for (value_name, labels), histogram in self.histograms.items():
+
+                    if value_name != name:
+                        continue
+
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+
+                    lines.append(f'{PREFIX}{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                    lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram["sum"]}')
+                    lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def snapshot(self) -> dict:
+        '''
+        Returns a JSON serializable copy of every metric and the recent ticks.
+        '''
+
+        with self._lock:
+            return {'time': time.time(),
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in self.counters.items()],
+                    'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                               for (name, labels), value in self.gauges.items()],
+                    'histograms': [{'name': name, 'labels': dict(labels), 'buckets': list(zip(BUCKETS, histogram['buckets'])),
+                                    'sum': histogram['sum'], 'count': histogram['count']}
+                                   for (name, labels), histogram in self.histograms.items()],
+                    'ticks': list(self.ticks)}
+
+
+    def write_json(self, path:str):
+        '''
+        Atomically writes the current snapshot to a JSON file.
+        '''
+
+        directory = os.path.dirname(os.path.abspath(path))
+        file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(file_descriptor, 'w') as json_file:
+                json.dump(self.snapshot(), json_file)
+
+            os.replace(temp_path, path)
+
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def format_labels(labels:tuple) -> str:
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class MetricsServer:
+    '''
+    Serves the registry as Prometheus text on http://<host>:<port>/metrics
+    from a background thread. Binds to localhost by default.
+    '''
+
+    def __init__(self, registry:Metrics, port:int, host:str='127.0.0.1'):
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = registry.render_prometheus().encode('utf-8')
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+
+    def start(self):
+
+        self.thread.start()
+        logger.info(f'Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics')
+
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Process wide registry, shared by every bot, like the root logger
+REGISTRY = Metrics()
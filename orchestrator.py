@@ -0,0 +1,204 @@
+import heapq
+import os
+import time
+
+import bot_logging
+import http_client
+import mafia_bot
+import metrics
+import post_queue
+import state_store
+import user
+
+logger = bot_logging.get_logger('orchestrator')
+
+
+class Orchestrator:
+    '''
+    Runs several games in a single process. Every game gets its own MafiaBot,
+    but all of them share one HTTP client (and so one connection pool and
+    page cache), one state store, one outbound post queue and one
+    authenticated forum session per bot account. Ticks are scheduled one after another, each game at its
+    own update interval.
+    '''
+
+    def __init__(self, client:http_client.HttpClient, store:state_store.StateStore,
+                 cookie_dir:str=None, metrics_json_file:str=None,
+                 outbound:post_queue.PostQueue=None):
+
+        self.http_client = client
+        self.state_store = store
+        self.cookie_dir  = cookie_dir
+
+        # Rolling JSON dump of the metrics registry, refreshed after every tick
+        self.metrics_json_file = metrics_json_file
+
+        # A single posting worker for every game
+        self.post_queue  = outbound or post_queue.PostQueue()
+
+        self.bots        = []
+
+        # Bot account (lowercase) -> shared ForumSession
+        self.sessions    = {}
+
+
+    def get_forum_session(self, user_id:str, password:str) -> user.ForumSession:
+        '''
+        Returns the forum session of a bot account, creating it on first use.
+
+        Parameters:
+        user_id (str): The mediavida account of the bot.
+        password (str): Its password.
+
+        Returns:
+        A user.ForumSession shared by every game posting with that account.
+        '''
+
+        key = user_id.lower()
+
+        if key not in self.sessions:
+
+            cookie_path = None
+
+            if self.cookie_dir:
+                os.makedirs(self.cookie_dir, exist_ok=True)
+                cookie_path = os.path.join(self.cookie_dir, f'{key}.cookies')
+
+            self.sessions[key] = user.ForumSession(user_id=user_id,
+                                                   password=password,
+                                                   cookie_path=cookie_path)
+
+        return self.sessions[key]
+
+
+    def add_game(self, game_url:str, game_master:str, bot_userID:str, bot_password:str,
+                 update_time_seconds:int, post_push_interval:int,
+                 vote_config_path:str='vote_config.csv', page_revalidate_seconds:int=3600,
+                 min_update_time_seconds:int=None, max_update_time_seconds:int=None,
+                 watch_interval_seconds:int=None, edit_policy:str='ignore') -> mafia_bot.MafiaBot:
+        '''
+        Builds a bot for a game thread using the shared resources.
+
+        Returns:
+        The new MafiaBot.
+        '''
+
+        bot = mafia_bot.MafiaBot(game_url=game_url,
+                                 game_master=game_master,
+                                 bot_userID=bot_userID,
+                                 bot_password=bot_password,
+                                 loop_waittime_seconds=update_time_seconds,
+                                 post_push_interval=post_push_interval,
+                                 client=self.http_client,
+                                 page_revalidate_seconds=page_revalidate_seconds,
+                                 store=self.state_store,
+                                 forum_session=self.get_forum_session(bot_userID, bot_password),
+                                 vote_config_path=vote_config_path,
+                                 min_update_time_seconds=min_update_time_seconds,
+                                 max_update_time_seconds=max_update_time_seconds,
+                                 watch_interval_seconds=watch_interval_seconds,
+                                 outbound=self.post_queue,
+                                 edit_policy=edit_policy)
+
+        self.bots.append(bot)
+
+        logger.info(f'Added game {game_url} run by {game_master}')
+
+        return bot
+
+
+    def run(self):
+        '''
+        Main loop. Runs the next due game tick, then schedules that game again
+        after the interval its adaptive poller decides.
+
+        Between ticks, games with the last page watcher enabled are watched at
+        their watch interval. When the watcher asks for it, the tick of that
+        game is moved forward to now.
+
+        An error in a game tick or watch is logged and counted, and only
+        delays that game until its normal update interval.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        # (run time, bot index, 'tick' or 'watch') min-heap
+        schedule  = [(time.monotonic(), index, 'tick') for index in range(len(self.bots))]
+        heapq.heapify(schedule)
+
+        # Bot index -> due time of its next tick. Tick entries with another
+        # due time were superseded by a watcher trigger and are dropped.
+        next_tick = {index: due for due, index, _ in schedule}
+
+        while schedule:
+
+            due, index, task = heapq.heappop(schedule)
+            bot              = self.bots[index]
+
+            if task == 'tick' and due != next_tick[index]:
+                continue
+
+            wait = due - time.monotonic()
+
+            if wait > 0:
+                logger.info(f'Sleeping for {wait:.0f} seconds.')
+                time.sleep(wait)
+
+            if task == 'watch':
+
+                try:
+                    triggered = bot.run_watch()
+
+                # A failing game must not stop the others. Its next tick
+                # stays scheduled.
+                except Exception:
+                    metrics.REGISTRY.inc('tick_errors_total', game=bot.thread_id)
+                    logger.exception(f'Last page watch of thread {bot.thread_id} failed')
+                    continue
+
+                if triggered:
+                    next_tick[index] = time.monotonic()
+                    heapq.heappush(schedule, (next_tick[index], index, 'tick'))
+
+                else:
+                    self.schedule_watch(schedule, bot, index, next_tick[index])
+
+                continue
+
+            logger.info(f'Running tick for thread {bot.thread_id}')
+
+            try:
+                bot.run_tick()
+                interval = bot.get_next_interval()
+
+            # A failing game must not stop the others. It is tried again at
+            # its normal update interval.
+            except Exception:
+                metrics.REGISTRY.inc('tick_errors_total', game=bot.thread_id)
+                logger.exception(f'Tick of thread {bot.thread_id} failed, retrying in {bot.update_tick} seconds')
+                interval = bot.update_tick
+
+            if self.metrics_json_file:
+                metrics.REGISTRY.write_json(self.metrics_json_file)
+
+            next_tick[index] = time.monotonic() + interval
+            heapq.heappush(schedule, (next_tick[index], index, 'tick'))
+
+            self.schedule_watch(schedule, bot, index, next_tick[index])
+
+
+    def schedule_watch(self, schedule:list, bot:mafia_bot.MafiaBot, index:int, next_tick:float):
+        '''
+        Schedules the next last page watch of a game, if it is enabled and
+        falls before its next tick.
+        '''
+
+        if not bot.should_watch():
+            return
+
+        watch_at = time.monotonic() + bot.watch_interval
+
+        if watch_at < next_tick:
+            heapq.heappush(schedule, (watch_at, index, 'watch'))
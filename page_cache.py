@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+class PageCache:
+    '''
+    Persistent on-disk cache of mediavida pages keyed by URL. Each entry
+    stores the page body, its ETag/Last-Modified validators and the time it
+    was last fetched or revalidated, so pages that no longer change can be
+    served from disk or revalidated with a conditional request.
+
+    That time is the modification time of the entry file, so a revalidation
+    only touches the file instead of writing the whole body again.
+    '''
+
+    def __init__(self, cache_dir:str='page_cache'):
+
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def get(self, url:str) -> dict:
+        '''
+        Retrieves a cached page.
+
+        Parameters:
+        url (str): The URL of the page.
+
+        Returns:
+        A dict with the url, body, etag, last_modified and fetched_at keys,
+        or None if the page is not cached.
+        '''
+
+        try:
+            with open(self.get_path(url), encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+                entry['fetched_at'] = os.fstat(cache_file.fileno()).st_mtime
+
+        except (OSError, ValueError):
+            return None
+
+        # Guard against hash collisions
+        if entry.get('url') != url:
+            return None
+
+        return entry
+
+
+    def store(self, url:str, body:str, etag:str=None, last_modified:str=None):
+        '''
+        Stores or replaces a page in the cache.
+
+        Parameters:
+        url (str): The URL of the page.
+        body (str): The page body.
+        etag (str): The ETag header of the response, if any.
+        last_modified (str): The Last-Modified header of the response, if any.
+
+        Returns: None
+        '''
+
+        self.write({'url': url,
+                    'body': body,
+                    'etag': etag,
+                    'last_modified': last_modified})
+
+
+    def touch(self, url:str, entry:dict):
+        '''
+        Marks a cached page as fresh after a successful revalidation. Only
+        the modification time of the entry file changes, unless the file is
+        gone and the entry has to be written again.
+        '''
+
+        entry['fetched_at'] = time.time()
+
+        try:
+            os.utime(self.get_path(url), (entry['fetched_at'], entry['fetched_at']))
+
+        except OSError:
+            self.write({key: value for key, value in entry.items() if key != 'fetched_at'})
+
+
+    def write(self, entry:dict):
+
+        # Write to a temporary file first so readers never see partial entries
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as cache_file:
+                json.dump(entry, cache_file)
+
+            os.replace(temp_path, self.get_path(entry['url']))
+
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def get_path(self, url:str) -> str:
+
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
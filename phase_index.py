@@ -0,0 +1,122 @@
+class PhaseIndex:
+    '''
+    Record of the game phase transitions announced by the GM. Each phase is
+    stored the first time its header is seen, together with the alive player
+    list of the day, so later iterations only need to look at GM posts newer
+    than the last one inspected.
+    '''
+
+    def __init__(self):
+
+        # Ordered list of {'day', 'start_post', 'end_post', 'player_list'} dicts
+        self.phases = []
+
+        # Newest GM post inspected so far and the GM filtered page holding it
+        self.last_seen_post = 0
+        self.last_seen_page = 1
+
+
+    def is_built(self) -> bool:
+        '''
+        Whether the GM posts have been scanned at least once.
+        '''
+
+        return self.last_seen_post > 0
+
+
+    def add_day_start(self, day:int, post_id:int, player_list:list):
+        '''
+        Records the start of a new day.
+
+        Parameters:\n
+        day (int): The day number, if the header had one.
+        post_id (int): The post ID of the day start.
+        player_list (list): The alive players listed in the day start post.
+
+        Returns: None
+        '''
+
+        self.phases.append({'day': day,
+                            'start_post': post_id,
+                            'end_post': None,
+                            'player_list': list(player_list)})
+
+
+    def add_day_end(self, day:int, post_id:int):
+        '''
+        Records the end of the current day. If the start of that day was never
+        seen (we started scanning after it), a phase with no start is stored.
+
+        Parameters:\n
+        day (int): The day number, if the header had one.
+        post_id (int): The post ID of the day end.
+
+        Returns: None
+        '''
+
+        current = self.get_current_phase()
+
+        if current is not None and current['end_post'] is None:
+            current['end_post'] = post_id
+
+            if current['day'] is None:
+                current['day'] = day
+
+        else:
+            self.phases.append({'day': day,
+                                'start_post': None,
+                                'end_post': post_id,
+                                'player_list': []})
+
+
+    def mark_seen(self, post_id:int, page:int):
+        '''
+        Moves the scan cursor forward.
+        '''
+
+        if post_id > self.last_seen_post:
+            self.last_seen_post = post_id
+            self.last_seen_page = page
+
+
+    def get_current_phase(self) -> dict:
+        '''
+        Returns the most recent phase, or None if no phase was found yet.
+        '''
+
+        return self.phases[-1] if self.phases else None
+
+
+    def is_day(self) -> bool:
+        '''
+        Whether the most recent phase is a day that has not ended.
+        '''
+
+        current = self.get_current_phase()
+
+        return current is not None and current['start_post'] is not None and current['end_post'] is None
+
+
+    def to_dict(self) -> dict:
+        '''
+        Serializable copy of the index, used for state checkpoints.
+        '''
+
+        return {'phases': self.phases,
+                'last_seen_post': self.last_seen_post,
+                'last_seen_page': self.last_seen_page}
+
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        '''
+        Rebuilds an index from the output of to_dict.
+        '''
+
+        index = cls()
+
+        index.phases         = data['phases']
+        index.last_seen_post = data['last_seen_post']
+        index.last_seen_page = data['last_seen_page']
+
+        return index
@@ -0,0 +1,240 @@
+import itertools
+import threading
+import time
+
+import bot_logging
+import metrics
+
+logger = bot_logging.get_logger('post')
+
+# Lower goes first
+PRIORITIES = {'lynch': 0, 'votecount': 1}
+
+
+class PostJob:
+    '''
+    A pending forum post. send performs the post and returns the URL the
+    forum redirected to, on_done receives that URL, or None if the post
+    was given up.
+    '''
+
+    def __init__(self, thread_id:int, account:str, kind:str, send, on_done, sequence:int, phase=None):
+
+        self.thread_id  = thread_id
+        self.account    = account
+        self.kind       = kind
+        self.phase      = phase
+        self.send       = send
+        self.on_done    = on_done
+        self.sequence   = sequence
+
+        self.attempts   = 0
+        self.not_before = 0.0
+
+    def get_key(self) -> tuple:
+
+        return (self.thread_id, self.kind)
+
+
+class PostQueue:
+    '''
+    Outbound forum posts, sent by a single background worker so counting
+    never waits for a form submit.
+
+    - A pending vote count of a thread is replaced by a newer one, so only
+      the latest count is posted.
+    - Lynch announcements go before any vote count and drop the pending
+      vote count of their thread. Once a lynch of a phase is queued, vote
+      counts of that thread and phase are refused.
+    - Posts of the same account are at least min_spacing_seconds apart.
+    - Failed posts are retried with a growing delay. Vote counts are given
+      up after max_retries, lynch announcements are never given up.
+    '''
+
+    def __init__(self, min_spacing_seconds:float=30, max_retries:int=3, retry_delay_seconds:float=15):
+
+        self.min_spacing   = min_spacing_seconds
+        self.max_retries   = max_retries
+        self.retry_delay   = retry_delay_seconds
+
+        self._condition    = threading.Condition()
+        self._sequence     = itertools.count()
+        self._worker       = None
+
+        # (thread id, kind) -> PostJob waiting to be sent
+        self.pending       = {}
+
+        # Keys of the job being sent right now
+        self.in_flight     = None
+
+        # account -> monotonic time of its last post
+        self.last_post_at  = {}
+
+        # thread id -> phase of its last queued lynch (pending, being sent
+        # or sent)
+        self.lynched_phase = {}
+
+
+    def submit(self, thread_id:int, account:str, kind:str, send, on_done, phase=None) -> bool:
+        '''
+        Queues a post.
+
+        Parameters:
+        thread_id (int): The thread the post goes to.
+        account (str): The forum account posting it, for post spacing.
+        kind (str): 'votecount' or 'lynch'.
+        send (callable): Performs the post and returns the resulting URL.
+        on_done (callable): Called from the worker with the URL, or None.
+        phase: The game phase the post belongs to, such as the first post
+        of the day. A vote count is refused after a lynch of the same phase.
+
+        Returns:
+        True/False (bool): Whether the post was queued.
+        '''
+
+        job = PostJob(thread_id, account.lower(), kind, send, on_done, next(self._sequence), phase)
+
+        with self._condition:
+
+            if kind == 'votecount' and thread_id in self.lynched_phase and self.lynched_phase[thread_id] == phase:
+                logger.warning(f'Refused a vote count of thread {thread_id}, the lynch of this phase was already queued')
+                metrics.REGISTRY.inc('posts_refused_total', kind=kind)
+                return False
+
+            if kind == 'lynch':
+                self.lynched_phase[thread_id] = phase
+
+            if kind == 'lynch' and self.pending.pop((thread_id, 'votecount'), None) is not None:
+                logger.info(f'Dropped the pending vote count of thread {thread_id} in favour of a lynch')
+
+            if job.get_key() in self.pending:
+                logger.info(f'Replaced the pending {kind} post of thread {thread_id}')
+                metrics.REGISTRY.inc('posts_coalesced_total', kind=kind)
+
+            self.pending[job.get_key()] = job
+
+            if self._worker is None:
+                self._worker = threading.Thread(target=self.run, name='post-queue', daemon=True)
+                self._worker.start()
+
+            self._condition.notify()
+
+        return True
+
+
+    def is_pending(self, thread_id:int, kind:str) -> bool:
+        '''
+        Whether a post of a thread is waiting or being sent.
+        '''
+
+        with self._condition:
+            return (thread_id, kind) in self.pending or self.in_flight == (thread_id, kind)
+
+
+    def wait_idle(self, timeout:float=None) -> bool:
+        '''
+        Blocks until every queued post was sent or given up.
+
+        Returns:
+        True/False (bool): False if the timeout expired first.
+        '''
+
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.pending and self.in_flight is None, timeout)
+
+
+    def get_next_job(self):
+        '''
+        Picks the next job that can be sent now. Must be called holding the
+        condition lock.
+
+        Returns:
+        A (job, wait) tuple. job is None when nothing is ready, and wait is
+        then the seconds until something may be, or None if the queue is empty.
+        '''
+
+        now   = time.monotonic()
+        ready = None
+        wait  = None
+
+        for job in self.pending.values():
+
+            ready_at = max(job.not_before, self.last_post_at.get(job.account, -self.min_spacing) + self.min_spacing)
+
+            if ready_at <= now:
+                if ready is None or (PRIORITIES[job.kind], job.sequence) < (PRIORITIES[ready.kind], ready.sequence):
+                    ready = job
+
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+
+        return ready, wait
+
+
+    def run(self):
+        '''
+        Worker loop. Sends jobs one at a time.
+        '''
+
+        while True:
+
+            with self._condition:
+
+                while True:
+
+                    job, wait = self.get_next_job()
+
+                    if job is not None:
+                        break
+
+                    self._condition.wait(wait)
+
+                del self.pending[job.get_key()]
+                self.in_flight = job.get_key()
+
+            self.send_job(job)
+
+            with self._condition:
+                self.in_flight = None
+                self._condition.notify_all()
+
+
+    def send_job(self, job:PostJob):
+
+        job.attempts += 1
+
+        try:
+            with metrics.REGISTRY.timer('post_queue_send_seconds', kind=job.kind):
+                post_url = job.send()
+
+        except Exception as e:
+
+            metrics.REGISTRY.inc('posts_failed_total', kind=job.kind)
+
+            with self._condition:
+
+                # A newer post of the same kind replaced this one meanwhile
+                if job.get_key() in self.pending:
+                    logger.warning(f'Failed to post {job.kind} in thread {job.thread_id}: {e}. A newer one is queued.')
+                    return
+
+                if job.kind == 'lynch' or job.attempts <= self.max_retries:
+
+                    job.not_before = time.monotonic() + self.retry_delay * job.attempts
+                    self.pending[job.get_key()] = job
+
+                    logger.warning(f'Failed to post {job.kind} in thread {job.thread_id}: {e}. '
+                                   f'Retrying in {self.retry_delay * job.attempts:.0f} seconds.')
+                    return
+
+            logger.error(f'Giving up posting {job.kind} in thread {job.thread_id} after {job.attempts} attempts: {e}')
+            job.on_done(None)
+            return
+
+        with self._condition:
+            self.last_post_at[job.account] = time.monotonic()
+
+        metrics.REGISTRY.inc('posts_sent_total', kind=job.kind)
+        logger.info(f'Posted {job.kind} in thread {job.thread_id}: {post_url}')
+
+        job.on_done(post_url)
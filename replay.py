@@ -0,0 +1,243 @@
+'''
+Offline replay of a stored game thread. Post records are read from saved
+HTML pages or from the bot page cache and run, in post order, through the
+same vote logic the live bot uses, without network access or posting.
+
+For every post it reports the vote table and whether a lynch was decided,
+which makes disputed counts auditable and lets whole corpora of finished
+games be re-counted in seconds.
+
+Usage:
+    python replay.py --thread-url URL --gm GM --vote-config vote_config.csv --html page1.html page2.html ...
+    python replay.py --thread-url URL --gm GM --vote-config vote_config.csv --page-cache page_cache [--json steps.jsonl]
+
+The replay counts every post up to a day end header, as a bot ticking
+continuously would. A live bot only counts the posts it saw before the
+night started.
+'''
+import argparse
+import json
+from typing import NamedTuple
+
+import mafia_bot
+import page_cache
+import state_store
+import thread_parser
+
+
+class ReplayStep(NamedTuple):
+    '''
+    State of the vote count right after a post was applied.
+    '''
+    post_id: int
+    author: str
+    day: int
+    votes: dict
+    majority: int
+    count_requested: bool
+    lynched: str
+
+
+class ReplayBot(mafia_bot.MafiaBot):
+    '''
+    A MafiaBot fed from a post record stream instead of the forum. Phase
+    changes are read from the GM posts as they come and lynches are recorded
+    instead of posted.
+    '''
+
+    def __init__(self, game_url:str, game_master:str, vote_config_path:str='vote_config.csv'):
+
+        super().__init__(game_url=game_url,
+                         game_master=game_master,
+                         bot_userID='',
+                         bot_password='',
+                         loop_waittime_seconds=0,
+                         post_push_interval=0,
+                         store=state_store.StateStore(':memory:'),
+                         vote_config_path=vote_config_path)
+
+        self.current_day  = None
+        self.day_open     = False
+        self.lynched      = None
+
+        # The live bot cursor starts at the first post, which it never
+        # counts. The replay must see it: it usually opens day 1.
+        self.last_processed_post = 0
+
+        self._tick_started = 0
+
+
+    def replay(self, posts):
+        '''
+        Applies a stream of post records to the vote state.
+
+        Parameters:
+        posts (iterable): PostRecord objects in post order. Posts already
+        applied (same or older post id) are skipped.
+
+        Returns:
+        A generator of ReplayStep, one per applied post.
+        '''
+
+        for post in posts:
+
+            if post.post_id <= self.last_processed_post:
+                continue
+
+            self.lynched         = None
+            self.gm_vote_request = False
+
+            if not self.apply_phase_transition(post) and self.day_open:
+                self.process_post(post)
+
+            self.last_processed_post = post.post_id
+
+            yield ReplayStep(post_id=post.post_id,
+                             author=post.author,
+                             day=self.current_day if self.day_open else None,
+                             votes={victim: self.vote_ledger.get_voters(victim)
+                                    for victim in self.vote_ledger.voters_by_victim},
+                             majority=self.get_vote_majority() if self.day_open else None,
+                             count_requested=self.gm_vote_request,
+                             lynched=self.lynched)
+
+
+    def apply_phase_transition(self, post:thread_parser.PostRecord) -> bool:
+        '''
+        Opens or closes a day when a GM post carries a phase header, the same
+        way is_day_phase and reset_vote_state do on the live bot.
+
+        Parameters:
+        post (PostRecord): The post being replayed.
+
+        Returns:
+        True/False (bool): Whether the post was a phase header.
+        '''
+
+        if post.author != self.game_master.lower():
+            return False
+
+        transition = thread_parser.get_phase_transition(post)
+
+        if transition is None:
+            return False
+
+        self.current_day = transition[1]
+        self.log_context['day'] = self.current_day
+
+        if transition[0] == 'end':
+            self.log.info(f'Replay: end of day {self.current_day} at post {post.post_id}')
+            self.day_open = False
+            return True
+
+        self.log.info(f'Replay: start of day {self.current_day} at post {post.post_id}')
+
+        self.day_open               = True
+        self.majority_reached       = False
+        self.current_day_start_post = post.post_id
+        self.player_list            = list(post.player_list)
+        self.vote_requests['vote_requested'] = 0
+
+        self.reset_vote_state()
+
+        return True
+
+
+    def lynch_player(self, victim:str, post_id:int):
+
+        self.log.info(f'Replay: {victim} lynched at {post_id}')
+
+        self.majority_reached = True
+        self.lynched          = victim
+
+
+def read_html_pages(paths:list):
+    '''
+    Yields the post records of saved thread pages, in the given order.
+    '''
+
+    for path in paths:
+        with open(path, encoding='utf-8') as html_file:
+            yield from thread_parser.parse_page(html_file.read()).posts
+
+
+def read_page_cache(cache:page_cache.PageCache, thread_url:str):
+    '''
+    Yields the post records of a thread stored in the page cache, from the
+    first page to the last cached one.
+    '''
+
+    page = 1
+
+    while True:
+
+        entry = cache.get(thread_url if page == 1 else f'{thread_url}/{page}')
+
+        if entry is None:
+            return
+
+        parsed = thread_parser.parse_page(entry['body'])
+
+        yield from parsed.posts
+
+        if page >= parsed.page_count:
+            return
+
+        page += 1
+
+
+def replay_game(thread_url:str, game_master:str, vote_config_path:str, posts) -> list:
+    '''
+    Replays a whole game and returns every ReplayStep.
+    '''
+
+    return list(ReplayBot(thread_url, game_master, vote_config_path).replay(posts))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Offline replay of a stored game thread')
+    parser.add_argument('--thread-url', required=True, help='game thread URL, ending with the thread id')
+    parser.add_argument('--gm', required=True, help='game master user name')
+    parser.add_argument('--vote-config', default='vote_config.csv', help='vote rights table')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--html', nargs='+', help='saved thread pages, in page order')
+    source.add_argument('--page-cache', help='page cache directory of the bot')
+    parser.add_argument('--json', help='write every step to this file as JSON lines')
+    args = parser.parse_args()
+
+    if args.html:
+        posts = read_html_pages(args.html)
+    else:
+        posts = read_page_cache(page_cache.PageCache(args.page_cache), args.thread_url)
+
+    bot   = ReplayBot(args.thread_url, args.gm, args.vote_config)
+    votes = None
+
+    json_file = open(args.json, 'w') if args.json else None
+
+    try:
+        for step in bot.replay(posts):
+
+            if json_file:
+                json_file.write(json.dumps(step._asdict()) + '\n')
+
+            # Only print the posts that change the count
+            if step.votes != votes or step.lynched or step.count_requested:
+
+                table = ', '.join(f'{victim} ({len(voters)}): {", ".join(voters)}'
+                                  for victim, voters in step.votes.items())
+
+                print(f'#{step.post_id} {step.author} day={step.day} majority={step.majority} | {table}'
+                      + (f' | LYNCH {step.lynched}' if step.lynched else '')
+                      + (' | GM count request' if step.count_requested else ''))
+
+                votes = step.votes
+
+    finally:
+        if json_file:
+            json_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+class AdaptivePoller:
+    '''
+    Decides how long a bot waits before its next iteration based on what the
+    last one found. Polling speeds up when votes come in, and especially when
+    a player is close to being lynched, and backs off exponentially while the
+    thread is idle or on night phase. The interval always stays between the
+    configured bounds.
+    '''
+
+    def __init__(self, base_interval:float, min_interval:float, max_interval:float,
+                 backoff_factor:float=2, near_majority_votes:int=2):
+
+        self.base_interval       = base_interval
+        self.min_interval        = min(min_interval, base_interval)
+        self.max_interval        = max(max_interval, base_interval)
+        self.backoff_factor      = backoff_factor
+        self.near_majority_votes = near_majority_votes
+
+        self.interval            = base_interval
+
+
+    def next_interval(self, activity:dict) -> float:
+        '''
+        Computes the wait before the next iteration.
+
+        Parameters:
+        activity (dict): Summary of the last iteration with the keys
+        day (bool), majority_reached (bool), new_posts (int), new_votes (int)
+        and votes_to_majority (int or None, the fewest votes any player needs
+        to be lynched).
+
+        Returns:
+        The number of seconds to wait.
+        '''
+
+        votes_to_majority = activity.get('votes_to_majority')
+
+        if not activity.get('day') or activity.get('majority_reached'):
+            # Nothing to count until the GM starts a new day
+            self.interval = self.interval * self.backoff_factor
+
+        elif votes_to_majority is not None and votes_to_majority <= self.near_majority_votes:
+            self.interval = self.min_interval
+
+        elif activity.get('new_votes'):
+            self.interval = min(self.interval, self.base_interval) / 2
+
+        elif activity.get('new_posts'):
+            self.interval = min(self.interval, self.base_interval)
+
+        else:
+            self.interval = self.interval * self.backoff_factor
+
+        self.interval = max(self.min_interval, min(self.max_interval, self.interval))
+
+        return self.interval
@@ -0,0 +1,105 @@
+import json
+import sqlite3
+import threading
+
+
+class StateStore:
+    '''
+    Small persistent key/value store for bot state, backed by an embedded
+    SQLite database. Values are stored as JSON and scoped by thread id, so
+    several games can share the same database file.
+    '''
+
+    def __init__(self, db_path:str='mafia_bot.db'):
+
+        self.db_path = db_path
+        self._lock   = threading.Lock()
+
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+
+        # Write-ahead logging keeps frequent checkpoints cheap
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS bot_state ('
+                                    'thread_id INTEGER NOT NULL, '
+                                    'key TEXT NOT NULL, '
+                                    'value TEXT, '
+                                    'PRIMARY KEY (thread_id, key))')
+
+
+    def get(self, thread_id:int, key:str, default=None):
+        '''
+        Reads a value of a game.
+
+        Parameters:
+        thread_id (int): The game thread id.
+        key (str): The state key.
+        default: Value returned when the key was never stored.
+
+        Returns:
+        The stored value.
+        '''
+
+        with self._lock:
+            row = self.connection.execute('SELECT value FROM bot_state WHERE thread_id = ? AND key = ?',
+                                          (thread_id, key)).fetchone()
+
+        if row is None:
+            return default
+
+        return json.loads(row[0])
+
+
+    def set(self, thread_id:int, key:str, value):
+        '''
+        Stores a value of a game.
+
+        Parameters:
+        thread_id (int): The game thread id.
+        key (str): The state key.
+        value: Any JSON serializable value.
+
+        Returns: None
+        '''
+
+        self.set_many(thread_id, {key: value})
+
+
+    def set_many(self, thread_id:int, values:dict):
+        '''
+        Stores several values of a game in a single transaction.
+
+        Parameters:
+        thread_id (int): The game thread id.
+        values (dict): Keys and JSON serializable values.
+
+        Returns: None
+        '''
+
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO bot_state (thread_id, key, value) VALUES (?, ?, ?)',
+                                        [(thread_id, key, json.dumps(value)) for key, value in values.items()])
+
+
+    def save_checkpoint(self, thread_id:int, checkpoint:dict):
+        '''
+        Atomically replaces the checkpoint of a game. Either the whole
+        checkpoint is written or, if anything fails, the previous one is kept.
+
+        Parameters:
+        thread_id (int): The game thread id.
+        checkpoint (dict): JSON serializable bot state.
+
+        Returns: None
+        '''
+
+        self.set(thread_id, 'checkpoint', checkpoint)
+
+
+    def load_checkpoint(self, thread_id:int) -> dict:
+        '''
+        Returns the last checkpoint of a game, or None if there is none.
+        '''
+
+        return self.get(thread_id, 'checkpoint')
@@ -0,0 +1,402 @@
+import concurrent.futures
+import hashlib
+import multiprocessing
+import re
+import sys
+from typing import NamedTuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
+
+import bot_logging
+
+try:
+    from bs4.filter import ElementFilter
+except ImportError: # BeautifulSoup < 4.13
+    ElementFilter = None
+
+logger = bot_logging.get_logger('parser')
+
+# MV has unique div elements for odd and even posts, and another one for the
+# very first post of the page. Only these carry player commands.
+COMMAND_POST_CLASSES = ('cf post', 'cf post z', 'cf post first')
+
+# HTML parsers BeautifulSoup can use, fastest first. lxml is optional,
+# html.parser ships with python and is always available.
+PARSER_BACKENDS = ('lxml', 'html.parser')
+
+
+class PostRecord(NamedTuple):
+    '''
+    Compact representation of a single thread post. It holds everything the
+    bot needs from a post so the HTML tree can be thrown away right after
+    the page is parsed.
+    '''
+    post_id: int
+    author: str
+    headers: tuple
+    commands: tuple
+    player_list: tuple
+    content_hash: str
+    # h4 commands of the post body whatever the post class. Edited posts are
+    # compared with these, since an edit may change the post class.
+    edit_commands: tuple = ()
+
+
+class ThreadPage(NamedTuple):
+    '''
+    A parsed mediavida page: its post records and the total page count read
+    from the bottom page panel.
+    '''
+    posts: tuple
+    page_count: int
+
+
+class ThreadSnapshot(NamedTuple):
+    '''
+    Page count and last post id of a thread at a given moment.
+    '''
+    page_count: int
+    last_post_id: int
+
+
+def get_available_backends() -> list:
+    '''
+    Returns the installed parser backends, fastest first.
+    '''
+
+    return [backend for backend in PARSER_BACKENDS if builder_registry.lookup(backend) is not None]
+
+
+def set_backend(name:str='auto'):
+    '''
+    Selects the parser backend used by parse_page.
+
+    Parameters:
+    name (str): 'lxml', 'html.parser' or 'auto' for the fastest installed one.
+
+    Returns: None
+    '''
+
+    global backend
+
+    if name == 'auto':
+        backend = get_available_backends()[0]
+
+    elif name in get_available_backends():
+        backend = name
+
+    else:
+        raise ValueError(f'Unknown or not installed parser backend: {name}')
+
+
+def is_page_element(name:str, attrs:dict) -> bool:
+    '''
+    Whether a top level tag is worth building: post containers and the
+    bottom page panel. Headers, sidebars and the rest of the page are
+    skipped while parsing.
+    '''
+
+    return name == 'div' and (('data-num' in attrs and 'data-autor' in attrs) or attrs.get('id') == 'bottompanel')
+
+
+if ElementFilter is not None:
+
+    class PageStrainer(ElementFilter):
+        '''
+        Only builds the tags accepted by is_page_element, and their contents.
+        '''
+
+        def allow_tag_creation(self, nsprefix, name, attrs):
+            return is_page_element(name, attrs or {})
+
+        def allow_string_creation(self, string):
+            return False
+
+    PAGE_STRAINER = PageStrainer()
+
+else:
+    PAGE_STRAINER = SoupStrainer(lambda name, attrs: is_page_element(name, dict(attrs)))
+
+
+backend = get_available_backends()[0]
+
+# Optional process pool parse stage, see set_parse_workers
+parse_workers        = 0
+parse_pool_min_pages = 4
+
+_parse_pool = None
+
+
+def parse_page(request_text:str) -> ThreadPage:
+    '''
+    Parses a mediavida thread page once and extracts a record for each post
+    in it, along with the page count of the thread. Only the post containers
+    and the bottom page panel are built into the tree, using the selected
+    parser backend (see set_backend).
+
+    Parameters:
+    request_text (str): A string of HTML text of a thread page.
+
+    Returns:
+    A ThreadPage with the post records, sorted as they appear, and the page count.
+    '''
+
+    parser = BeautifulSoup(request_text, backend, parse_only=PAGE_STRAINER)
+
+    posts = tuple(parse_post(post) for post in parser.find_all('div', attrs={'data-num':True,
+                                                                             'data-autor':True}))
+
+    page_count = get_page_count(parser)
+
+    # The tree is full of parent/child reference cycles. Break them so its
+    # memory is released right away instead of on the next garbage collection.
+    parser.decompose()
+
+    return ThreadPage(posts=posts, page_count=page_count)
+
+
+def set_parse_workers(workers:int=0, min_pages:int=4):
+    '''
+    Sets up the process pool parse stage used by parse_pages. BeautifulSoup
+    parsing is pure python and single core, so a cold count over many pages
+    can spread it over several processes.
+
+    Parameters:
+    workers (int): Parser processes. 0 or 1 parses in the calling process.
+    min_pages (int): Batches smaller than this are parsed in the calling
+    process, where the pool overhead would dominate.
+
+    Returns: None
+    '''
+
+    global parse_workers, parse_pool_min_pages
+
+    shutdown_parse_pool()
+
+    parse_workers        = max(0, workers)
+    parse_pool_min_pages = max(1, min_pages)
+
+
+def uses_parse_pool(pages:int) -> bool:
+    '''
+    Whether parse_pages sends a batch of that many pages to the parser
+    process pool.
+    '''
+
+    return parse_workers > 1 and pages >= parse_pool_min_pages
+
+
+def get_pool_batch_size() -> int:
+    '''
+    Smallest batch that keeps every parser process busy and is sent to the
+    pool, or 1 when the pool is disabled.
+    '''
+
+    if parse_workers <= 1:
+        return 1
+
+    return max(parse_workers, parse_pool_min_pages)
+
+
+def get_parse_pool() -> concurrent.futures.ProcessPoolExecutor:
+    '''
+    Returns the parser process pool, starting it on first use. Processes are
+    spawned rather than forked, the bot already runs threads when the pool
+    starts.
+    '''
+
+    global _parse_pool
+
+    if _parse_pool is None:
+        _parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers,
+                                                             mp_context=multiprocessing.get_context('spawn'))
+
+    return _parse_pool
+
+
+def shutdown_parse_pool():
+    '''
+    Stops the parser processes, if any. The pool is started again on the
+    next parse_pages call that needs it.
+    '''
+
+    global _parse_pool
+
+    if _parse_pool is not None:
+        _parse_pool.shutdown(cancel_futures=True)
+        _parse_pool = None
+
+
+def parse_page_with(backend_name:str, request_text:str) -> ThreadPage:
+    '''
+    parse_page with a given parser backend. Runs in the parser processes,
+    which do not share the backend selected in the main one.
+    '''
+
+    global backend
+
+    backend = backend_name
+
+    return parse_page(request_text)
+
+
+def parse_pages(request_texts:list) -> list:
+    '''
+    Parses several pages, in the parser process pool when there is one and
+    the batch is large enough, otherwise one after another. Only the compact
+    records travel back from the parser processes. If the pool breaks, the
+    pages are parsed in the calling process and the pool is started again
+    next time.
+
+    Parameters:
+    request_texts (list): HTML texts of thread pages.
+
+    Returns:
+    A list of ThreadPage, in the same order.
+    '''
+
+    if uses_parse_pool(len(request_texts)):
+
+        try:
+            return list(get_parse_pool().map(parse_page_with, [backend] * len(request_texts), request_texts))
+
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logger.warning(f'The parser process pool broke, parsing in the bot process: {e}')
+            shutdown_parse_pool()
+
+    return [parse_page(request_text) for request_text in request_texts]
+
+
+def parse_post(post) -> PostRecord:
+    '''
+    Builds a PostRecord from a BeautifulSoup post element.
+
+    Commands (h4 elements) are only counted from regular post bodies, edit
+    div elements are ignored. Edits of counted posts are noticed through the
+    content hash instead, and their commands are read from edit_commands,
+    which does not depend on the post class (see MafiaBot.check_edit).
+
+    Parameters:
+    post: A BeautifulSoup div element with data-num and data-autor attributes.
+
+    Returns:
+    A PostRecord.
+    '''
+
+    content       = post.find('div', class_ = 'post-contents')
+    edit_commands = ()
+    commands      = ()
+
+    if content is not None:
+        edit_commands = tuple(command.text.lower() for command in content.find_all('h4'))
+
+    if ' '.join(post.get('class', [])) in COMMAND_POST_CLASSES:
+        commands = edit_commands
+
+    # Get the first list. It should be the player list according to the day start template
+    player_list = ()
+    first_list  = post.find('ol')
+
+    if first_list is not None:
+        player_list = tuple(player.get_text().lower() for player in first_list.find_all('a'))
+
+    headers = tuple(header.text for header in post.find_all('h2'))
+
+    # Hash the text and the commands rather than the markup, which parser
+    # backends normalize differently
+    content_text = content.get_text() if content is not None else ''
+
+    # The same few authors repeat over thousands of records
+    return PostRecord(post_id=int(post['data-num']),
+                      author=sys.intern(post['data-autor'].lower()),
+                      headers=headers,
+                      commands=commands,
+                      player_list=player_list,
+                      content_hash=hash_content('\n'.join((content_text,) + headers + commands)),
+                      edit_commands=edit_commands,
+                      )
+
+
+def get_page_count(parser) -> int:
+    '''
+    Reads the page count of a thread from the bottom page panel of an already
+    parsed page: the highest page number linked from it. The panel only has
+    a trailing "next" link on pages other than the last one, so its position
+    can not be relied on.
+
+    Parameters:
+    parser: A BeautifulSoup tree of a mediavida page.
+
+    Returns:
+    An int representing the total page length of the thread.
+    '''
+
+    panel_layout = parser.find('div', id = 'bottompanel')
+
+    if panel_layout is None:
+        return 1
+
+    page_numbers = [int(link.get_text()) for link in panel_layout.find_all('a') if link.get_text().strip().isdigit()]
+
+    return max(page_numbers, default=1)
+
+
+def hash_content(content:str) -> str:
+    '''
+    Short, fast hash of a post body used to notice edited posts.
+    '''
+
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def get_phase_transition(post:PostRecord):
+    '''
+    Looks for GM phase headers in a post.
+
+    Parameters:
+    post (PostRecord): The post to evaluate.
+
+    Returns:
+    A ('end', day) tuple if a "Final del día N" header is found, a
+    ('start', day) tuple for a "Día N" header and None otherwise. The day is
+    None when the header carries no number.
+    '''
+
+    transition = None
+
+    for header in post.headers:
+
+        phase_end   = re.findall('^Final del día ([0-9]*)', header)
+        phase_start = re.findall('^Día ([0-9]*)', header)
+
+        if phase_end:
+            return ('end', int(phase_end[0]) if phase_end[0] else None)
+
+        elif phase_start and transition is None:
+            transition = ('start', int(phase_start[0]) if phase_start[0] else None)
+
+    return transition
+
+
+def get_votecount_type(post:PostRecord):
+    '''
+    Looks for bot vote count headers in a post.
+
+    Parameters:
+    post (PostRecord): The post to evaluate.
+
+    Returns:
+    'final' for a lynch vote count, 'regular' for a regular vote count and
+    None otherwise.
+    '''
+
+    for header in post.headers:
+
+        if re.findall('^Recuento de votos final$', header):
+            return 'final'
+
+        elif re.findall('^Recuento de votos$', header):
+            return 'regular'
+
+    return None
@@ -5,16 +5,153 @@ import werkzeug
 werkzeug.cached_property  = werkzeug.utils.cached_property
 from robobrowser import RoboBrowser
 
+import os
+import pickle
+import threading
+
 import pandas as pd
 
+import bot_logging
+import metrics
+import vote_rights
+
+logger = bot_logging.get_logger('post')
+
+
+class ForumSession:
+    '''
+    Long lived authenticated mediavida session. It logs in once, reuses its
+    cookies for every post, transparently logs in again when the session
+    expires and can keep its cookies on disk across restarts.
+    '''
+
+    def __init__(self, user_id:str, password:str, cookie_path:str=None):
+
+        self.user_id     = user_id
+        self.password    = password
+        self.cookie_path = cookie_path
+
+        self.browser     = None
+
+        # Posting is a multi request exchange, never interleave two of them
+        self._lock       = threading.Lock()
+
+
+    def get_browser(self) -> RoboBrowser:
+        '''
+        Returns the authenticated browser, restoring the stored cookies or
+        logging in if there is no browser yet.
+        '''
+
+        if self.browser is None:
+            self.browser = self.restore_cookies() or self.login()
+
+        return self.browser
+
+
+    def login(self) -> RoboBrowser:
+
+        logger.info(f'Logging into mediavida as {self.user_id}')
+
+        with metrics.REGISTRY.timer('forum_login_seconds'):
+
+            self._browser = RoboBrowser(parser="html.parser")
+            self._browser.open('http://m.mediavida.com/login')
+
+            self._login = self._browser.get_form(id='login_form')
+            self._login['name'].value = self.user_id
+            self._login['password'].value = self.password
+
+            self._browser.submit_form(self._login)
+
+        self.save_cookies(self._browser)
+
+        return self._browser
+
+
+    def restore_cookies(self) -> RoboBrowser:
+        '''
+        Builds a browser with the cookies stored on disk, if any. Whether
+        they are still valid is only found out when posting.
+        '''
+
+        if not self.cookie_path or not os.path.exists(self.cookie_path):
+            return None
+
+        try:
+            with open(self.cookie_path, 'rb') as cookie_file:
+                self._cookies = pickle.load(cookie_file)
+
+        except Exception as e:
+            logger.warning(f'Could not load session cookies from {self.cookie_path}: {e}')
+            return None
+
+        self._browser = RoboBrowser(parser="html.parser")
+        self._browser.session.cookies.update(self._cookies)
+
+        logger.info('Restored mediavida session from disk')
+
+        return self._browser
+
+
+    def save_cookies(self, browser:RoboBrowser):
+
+        if not self.cookie_path:
+            return
+
+        try:
+            with open(self.cookie_path, 'wb') as cookie_file:
+                pickle.dump(browser.session.cookies, cookie_file)
+
+        except OSError as e:
+            logger.warning(f'Could not save session cookies to {self.cookie_path}: {e}')
+
+
+    def post(self, thread_id:int, message:str) -> str:
+        '''
+        Posts a message in a thread. If the post form is not available the
+        session has expired, so we log in again and retry once.
+
+        Parameters:
+        thread_id (int): The thread to post in.
+        message (str): The message body.
+
+        Returns:
+        The URL the forum redirected to after posting.
+        '''
+
+        with self._lock, metrics.REGISTRY.timer('forum_post_seconds'):
+
+            for self._attempt in range(2):
+
+                self._browser = self.get_browser()
+                self._browser.open(f'http://www.mediavida.com/foro/post.php?tid={thread_id}')
+
+                self._post = self._browser.get_form(id='postear')
+
+                if self._post is None:
+                    logger.warning('Post form not found, the session expired. Logging in again.')
+                    self.browser = self.login()
+                    continue
+
+                self._post['cuerpo'].value = message
+                self._browser.submit_form(self._post)
+
+                return self._browser.url
+
+        raise RuntimeError(f'Could not open the post form of thread {thread_id} after logging in')
+
+
 class User:
 
     def  __init__(self, thread_id:int, thread_url:str, bot_id:str,
-                  bot_password:str, game_master:str):
+                  bot_password:str, game_master:str, session:ForumSession=None,
+                  vote_config_path:str='vote_config.csv', rights:vote_rights.VoteRights=None):
 
         
-        # Load vote rights table, we need vote visibility info.
-        self.vote_config = pd.read_csv('vote_config.csv', sep=',')
+        # Vote rights table, we need vote visibility info. Shared with the bot
+        # when given, so both see the same (reloaded) table.
+        self.vote_rights = rights or vote_rights.VoteRights(vote_config_path)
 
         # Attempt to log into MV with these credentials.
         #TODO: Log errors here
@@ -27,16 +164,23 @@ class User:
 
         self.game_master = game_master
 
-        self.browser = self.login(self.user_id, self.password)
+        # (fingerprint, text) of the last rendered vote ranking
+        self._rendered_ranking = (None, '')
+
+        # Log in once, the session is reused for every post
+        self.session = session or ForumSession(self.user_id, self.password)
+        self.session.get_browser()
        
 
-    def push_votecount(self, vote_count, alive_players, vote_majority, post_id):
+    def push_votecount(self, vote_count, alive_players, vote_majority, post_id, fingerprint=None, edited_posts=None):
 
         self._message_to_post = self.generate_vote_message(vote_count=vote_count,
                                                            alive_players=alive_players,
                                                            vote_majority=vote_majority,
-                                                           post_id=post_id)
-        self.post(self._message_to_post)
+                                                           post_id=post_id,
+                                                           fingerprint=fingerprint,
+                                                           edited_posts=edited_posts)
+        return self.post(self._message_to_post)
 
     
     def push_lynch(self, last_votecount, victim, post_id):
@@ -44,41 +188,32 @@ class User:
         self._message_to_post = self.generate_lynch_message(last_votecount=last_votecount,
                                                             victim=victim,
                                                             post_id=post_id)
-        self.post(self._message_to_post)
+        return self.post(self._message_to_post)
 
    
-    def login(self, user, password):
-
-        self._browser = RoboBrowser(parser="html.parser")
-        self._browser.open('http://m.mediavida.com/login')
-
-        self._login = self._browser.get_form(id='login_form')
-        self._login['name'].value = user
-        self._login['password'].value = password
-
-        self._browser.submit_form(self._login)
-
-        return self._browser
-
-
     def post(self, message):
 
-        self.browser.open(f'http://www.mediavida.com/foro/post.php?tid={self.thread_id}')
-        self._post  = self.browser.get_form(id='postear')
-        self._post['cuerpo'].value = message
-        
-        self.browser.submit_form(self._post)
-        
-        return self.browser.url
+        return self.session.post(self.thread_id, message)
 
-    def generate_vote_message(self, vote_count: pd.DataFrame, alive_players:int, vote_majority:int, post_id:int):
+    def generate_vote_message(self, vote_count: pd.DataFrame, alive_players:int, vote_majority:int, post_id:int,
+                              fingerprint:str=None, edited_posts:list=None):
 
         self._header = "# Recuento de votos \n"
 
-        self._votes_rank  = self.generate_string_from_vote_count(vote_count)
+        # The ranking only changes with the vote table, reuse it when the
+        # fingerprint of the table is the same as last time
+        if fingerprint is None or self._rendered_ranking[0] != fingerprint:
+            self._rendered_ranking = (fingerprint, self.generate_string_from_vote_count(vote_count))
+
+        self._votes_rank  = self._rendered_ranking[1]
 
         self._footer  = (f'_Con {alive_players}  jugadores vivos, la mayoría se alcanza con {vote_majority} votos._ \n')
         self._updated = (f'_Actualizado hasta el mensaje: {post_id}._ \n \n')
+
+        # Posts whose votes were edited after being counted. The edits are not counted.
+        if edited_posts:
+            self._updated = (f'_Votos editados tras ser contados, no se tienen en cuenta: '
+                             f'{", ".join(f"#{edited_post}" for edited_post in edited_posts)}._ \n') + self._updated
         self._bot_ad  = "**Soy un bot de recuento automático. Por favor, no me cites _¡N'wah!_** \n"
 
         self._message  = self._header + self._votes_rank + '\n' + self._footer + self._updated + self._bot_ad
@@ -94,7 +229,7 @@ class User:
         for i in range(0, len(self._vote_count)):
 
             self._player = self._vote_count.index[i]
-            self._votes  = self._vote_count[i]
+            self._votes  = self._vote_count.iloc[i]
             
             self._voters  = vote_count.loc[vote_count['player'] == self._player, 'voted_by'].tolist()
             self._voters  = ', '.join(self._voters)
@@ -0,0 +1,137 @@
+import collections
+
+import pandas as pd
+
+
+class VoteLedger:
+    '''
+    In-memory vote table of the current day. Votes are indexed by voter and
+    by victim, so casting, unvoting and counting are all constant time
+    operations regardless of how many votes the day accumulates.
+    '''
+
+    def __init__(self):
+
+        self._next_vote_id    = 0
+
+        # vote id -> (victim, voter, post_id). Dicts keep insertion order,
+        # so this is also the chronological vote table.
+        self.votes            = {}
+
+        # voter -> vote ids, oldest first
+        self.votes_by_voter   = collections.defaultdict(collections.deque)
+
+        # victim -> {vote id: voter}, oldest first
+        self.voters_by_victim = collections.defaultdict(dict)
+
+
+    def cast(self, voter:str, victim:str, post_id:int):
+        '''
+        Adds a vote to the ledger.
+
+        Parameters:\n
+        voter (str): The player who casts the vote.
+        victim (str): The player who receives the vote.
+        post_id (int): The post ID where the vote was casted.
+
+        Returns: None
+        '''
+
+        vote_id = self._next_vote_id
+        self._next_vote_id += 1
+
+        self.votes[vote_id] = (victim, voter, post_id)
+        self.votes_by_voter[voter].append(vote_id)
+        self.voters_by_victim[victim][vote_id] = voter
+
+
+    def unvote(self, voter:str):
+        '''
+        Removes the oldest vote casted by a player.
+
+        Parameters:\n
+        voter (str): The player who removes their vote.
+
+        Returns:\n
+        The removed (victim, voter, post_id) tuple, or None if the player had
+        no votes.
+        '''
+
+        if not self.votes_by_voter.get(voter):
+            return None
+
+        vote_id = self.votes_by_voter[voter].popleft()
+        vote    = self.votes.pop(vote_id)
+
+        del self.voters_by_victim[vote[0]][vote_id]
+
+        if not self.voters_by_victim[vote[0]]:
+            del self.voters_by_victim[vote[0]]
+
+        return vote
+
+
+    def get_votes_cast(self, voter:str) -> int:
+        '''
+        Returns how many active votes a player has casted.
+        '''
+
+        return len(self.votes_by_voter.get(voter, ()))
+
+
+    def get_vote_count(self, victim:str) -> int:
+        '''
+        Returns how many active votes a player has received.
+        '''
+
+        return len(self.voters_by_victim.get(victim, ()))
+
+
+    def get_voters(self, victim:str) -> list:
+        '''
+        Returns the players voting a given victim, in vote order.
+        '''
+
+        return list(self.voters_by_victim.get(victim, {}).values())
+
+
+    def __len__(self):
+
+        return len(self.votes)
+
+
+    def to_records(self) -> list:
+        '''
+        Returns the active votes as (victim, voter, post_id) tuples in
+        chronological order.
+        '''
+
+        return list(self.votes.values())
+
+
+    @classmethod
+    def from_records(cls, records:list):
+        '''
+        Rebuilds a ledger from the output of to_records.
+        '''
+
+        ledger = cls()
+
+        for victim, voter, post_id in records:
+            ledger.cast(voter=voter, victim=victim, post_id=post_id)
+
+        return ledger
+
+
+    def to_frame(self) -> pd.DataFrame:
+        '''
+        Exports the ledger in chronological order to the vote table layout
+        used by the vote count messages.
+
+        Parameters: None
+
+        Returns:
+        A pandas DataFrame with player (victim), voted_by and post_id columns.
+        '''
+
+        return pd.DataFrame(self.to_records(), columns=['player', 'voted_by', 'post_id'])
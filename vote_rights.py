@@ -0,0 +1,113 @@
+import os
+
+import pandas as pd
+
+import bot_logging
+
+logger = bot_logging.get_logger('rights')
+
+# Integer columns of the vote rights table
+RIGHTS_COLUMNS = ('can_be_voted', 'allowed_votes', 'mod_to_lynch', 'hidden_mod', 'allowed_vote_requests')
+
+
+class VoteRights:
+    '''
+    The vote rights table (vote_config.csv) compiled into a plain dict keyed
+    by lowercase player name, so every lookup is a dict hit. The file is read
+    once and read again, atomically replacing the table, when its
+    modification time changes. A single instance is shared by the bot and
+    its posting client.
+    '''
+
+    def __init__(self, path:str='vote_config.csv'):
+
+        self.path       = path
+
+        # lowercase player -> {'player': real name, column: int, ...}
+        self.rights     = {}
+
+        self._file_stat = None
+
+        self.load()
+
+
+    def load(self):
+        '''
+        Reads and compiles the table. The new table replaces the old one in
+        a single assignment, so readers never see a half loaded table.
+
+        Parameters: None
+
+        Returns: None
+        '''
+
+        file_stat = os.stat(self.path)
+        table     = pd.read_csv(self.path, sep=',')
+
+        missing_columns = [column for column in ('player',) + RIGHTS_COLUMNS if column not in table.columns]
+
+        if missing_columns:
+            raise ValueError(f'{self.path} lacks the columns {", ".join(missing_columns)}')
+
+        rights = {}
+
+        for row in table.to_dict('records'):
+            rights[str(row['player']).lower()] = dict({'player': row['player']},
+                                                      **{column: int(row[column]) for column in RIGHTS_COLUMNS})
+
+        self.rights     = rights
+        self._file_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        logger.info(f'Loaded vote rights of {len(self.rights)} players from {self.path}')
+
+
+    def reload_if_changed(self) -> bool:
+        '''
+        Reloads the table if the file changed since it was last loaded. A file
+        that can not be read (for instance, while it is being edited) keeps
+        the current table and is tried again on the next call.
+
+        Parameters: None
+
+        Returns:
+        True/False (bool): Whether a new table was loaded.
+        '''
+
+        try:
+            file_stat = os.stat(self.path)
+        except OSError as e:
+            logger.warning(f'Could not check the vote rights file {self.path}: {e}')
+            return False
+
+        if (file_stat.st_mtime_ns, file_stat.st_size) == self._file_stat:
+            return False
+
+        try:
+            self.load()
+
+        except Exception as e:
+            logger.error(f'Could not reload the vote rights file {self.path}, keeping the current table: {e}')
+            return False
+
+        return True
+
+
+    def get(self, player:str, column:str) -> int:
+        '''
+        Returns a right of a player. Raises KeyError for unknown players.
+        '''
+
+        return self.rights[player][column]
+
+
+    def get_real_names(self) -> dict:
+        '''
+        Returns a lowercase player -> real mediavida name dict.
+        '''
+
+        return {player: rights['player'] for player, rights in self.rights.items()}
+
+
+    def __contains__(self, player:str) -> bool:
+
+        return player in self.rights